@@ -27,7 +27,7 @@ from fastmp import fastMP
 
 
 def main(
-    dbs_folder='databases/', DBs_json='all_dbs.json', sep=',', N_dups=10
+    dbs_folder='databases/', DBs_json='all_dbs.json', sep=','
 ):
     """
     """
@@ -49,33 +49,30 @@ def main(
 
     db_matches = DBs_combine.get_matches_new_DB(df_comb, new_DB_fnames)
 
-    new_db_dict, idx_rm_comb_db = DBs_combine.combine_new_DB(
+    df_new_db, idx_rm_comb_db = DBs_combine.combine_new_DB(
         new_DB, df_comb, df_new, json_pars, new_DB_fnames, db_matches, sep)
     print(f"N={len(df_new) - len(idx_rm_comb_db)} new clusters in new DB")
 
-    # Add UCC_IDs and quadrant for new clusters
-    ucc_ids_old = list(df_comb['UCC_ID'].values)
-    for i, UCC_ID in enumerate(new_db_dict['UCC_ID']):
-        if str(UCC_ID) != 'nan':
-            # This cluster already has a UCC_ID assigned
-            continue
-        lon_i, lat_i = new_db_dict['GLON'][i], new_db_dict['GLAT'][i]
-        new_db_dict['UCC_ID'][i] = DBs_combine.assign_UCC_ids(
-            lon_i, lat_i, ucc_ids_old)
-        new_db_dict['quad'][i] = DBs_combine.QXY_fold(new_db_dict['UCC_ID'][i])
-        ucc_ids_old += [new_db_dict['UCC_ID'][i]]
+    # Add UCC_IDs and quadrant for new clusters (those with no UCC_ID
+    # assigned)
+    msk_new = df_new_db['UCC_ID'].isna().values
+    ucc_ids = DBs_combine.UCCIDAllocator(df_comb['UCC_ID'].values)
+    ucc_ids_new = ucc_ids.assign(
+        df_new_db['GLON'].values[msk_new], df_new_db['GLAT'].values[msk_new])
+    df_new_db.loc[msk_new, 'UCC_ID'] = ucc_ids_new
+    df_new_db.loc[msk_new, 'quad'] = [
+        DBs_combine.QXY_fold(_) for _ in ucc_ids_new]
 
     # Remove clusters in the new DB that were already in the old combined DB
     df_comb_no_new = df_comb.drop(df_comb.index[idx_rm_comb_db])
     df_comb_no_new.reset_index(drop=True, inplace=True)
-    df_all = pd.concat([df_comb_no_new, pd.DataFrame(new_db_dict)],
-                       ignore_index=True)
+    df_all = pd.concat([df_comb_no_new, df_new_db], ignore_index=True)
 
     # These duplicates are different from the final ones that are stored in
     # the final version of the catalogue. These are used to remove close
     # clusters from the field so that fastMP won't get confused
-    print(f"Finding possible duplicates (max={N_dups})...")
-    df_all['dups_fnames'] = DBs_combine.dups_identify(df_all, N_dups)
+    print("Finding possible duplicates...")
+    df_all['dups_fnames'], _ = DBs_combine.dups_identify(df_all)
 
     d = datetime.datetime.now()
     date_new = d.strftime('%Y%m%d')
@@ -88,11 +85,14 @@ def main(
         UCC_cat, na_rep='nan', index=False, quoting=csv.QUOTE_NONNUMERIC)
     print(f"File {UCC_cat} updated")
 
-    # Process each cluster in the new DB with fastMP and store the result in
-    # the output folder. This function will also update the UCC cat file
-    # 'df_UCC' with values for the columns that are still marked with 'nan'
+    # Process each cluster affected by the new DB with fastMP and store the
+    # result in the output folder. This function will also update the UCC
+    # cat file 'df_UCC' with the values for the re-processed clusters. The
+    # clusters to process are those that changed with respect to the old
+    # catalogue (not only those in 'new_DB'), see 'rerun_plan.run'
     df_UCC = fastMP_process.run(
-        fastMP, new_DB, frames_path, frames_ranges, UCC_cat, GCs_cat, out_path)
+        fastMP, None, frames_path, frames_ranges, UCC_cat, GCs_cat, out_path,
+        UCC_cat_old="UCC_cat_" + UCC_cat_date_old + ".csv")
 
     # Finally identify possible duplicates (and assign a probability) using
     # the positions estimated with the most likely members.
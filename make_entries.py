@@ -1,9 +1,12 @@
 
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import json
 import pandas as pd
+import matplotlib
 from add_new_DB import new_DB
-from modules import ucc_plots, ucc_entry
+from modules import ucc_plots, ucc_entry, call_fastMP, DBs_cache, DBs_combine
 
 
 # Date of the latest version of the catalogue
@@ -13,81 +16,193 @@ UCC_cat_date_new = "20230508"
 # new_DB = ''
 
 
-def main(entries_path="../ucc/_clusters/", N_membs_min=25):
+def main(entries_path="../ucc/_clusters/", N_membs_min=25, N_workers=1):
     """
+    N_workers: number of processes used to generate the files. If 1, the
+    clusters are processed serially in this process
+
+    A cluster that fails does not stop the run. Failed clusters are listed
+    at the end, grouped by the error raised
     """
     print("Reading databases...")
     with open('databases/all_dbs.json') as f:
         DBs_used = json.load(f)
-    DBs_data = {}
-    for k, v in DBs_used.items():
-        DBs_data[k] = pd.read_csv("databases/" + k + '.csv')
 
     # Read latest UCC catalogue
     UCC_data = pd.read_csv('UCC_cat_' + UCC_cat_date_new + '.csv')
 
+    # Only generate new entries for those clusters in the recently added
+    # database (all the entries if 'new_DB' is empty), and for those
+    # re-processed by fastMP (listed in the re-run plan, see
+    # 'fastMP_process.run')
+    if new_DB != '':
+        rows_new = DBs_combine.get_DB_rows(UCC_data, new_DB)
+        plan_file = 'UCC_cat_' + UCC_cat_date_new + '_rerun.csv'
+        if Path(plan_file).is_file():
+            df_plan = pd.read_csv(plan_file)
+            msk_plan = UCC_data['UCC_ID'].isin(df_plan['UCC_ID']).values
+            rows_new = np.union1d(rows_new, np.flatnonzero(msk_plan))
+    else:
+        rows_new = np.arange(len(UCC_data))
+
     # Load notebook template
     with open("notebook.txt", "r") as f:
         ntbk_str = f.readlines()
 
-    for i, row in UCC_data.iterrows():
+    state = entries_state(
+        DBs_used, UCC_data, ntbk_str, entries_path, N_membs_min)
+    # Read the DBs used by these clusters before the workers are started, so
+    # that they are shared by all the workers instead of each one reading
+    # (and caching) them at the same time
+    DBs_rows = set(';'.join(UCC_data['DB'].values[rows_new]).split(';'))
+    for db in sorted(DBs_rows):
+        state['DBs_data'][db]
 
-        # Only generate new entries for those clusters in the recently added
-        # database
-        if new_DB not in row['DB']:
-            continue
+    # Clusters that failed, grouped by error
+    failed = {}
 
+    def store(N_done, i, error):
+        row = UCC_data.iloc[i]
         fname0 = row['fnames'].split(';')[0]
+        print(f"{N_done}/{len(rows_new)}", row['DB'], row['quad'], fname0)
+        if error is not None:
+            print("  Failed:", error)
+            failed.setdefault(error, []).append(fname0)
+
+    if N_workers > 1:
+        with ProcessPoolExecutor(
+            N_workers, initializer=init_worker, initargs=(state,)
+        ) as executor:
+            futures = {executor.submit(process_entry, i): i for i in rows_new}
+            try:
+                for N_done, future in enumerate(as_completed(futures), 1):
+                    store(N_done, futures[future], future.result())
+            except BaseException:
+                # Do not process the remaining clusters
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+    else:
+        for N_done, i in enumerate(rows_new, 1):
+            store(N_done, i, make_cluster_files(i, state))
+
+    if failed:
+        N_failed = sum(len(_) for _ in failed.values())
+        print(f"\n{N_failed} of {len(rows_new)} clusters failed")
+        for error, fnames in failed.items():
+            print(f"{error} ({len(fnames)}): {', '.join(fnames)}")
+
+    return failed
+
+
+def entries_state(DBs_used, UCC_data, ntbk_str, entries_path, N_membs_min):
+    """
+    Data shared by all the clusters processed by a single process
+    """
+    return {
+        # Each DB is read when first used, see 'main'
+        'DBs_data': DBs_cache.DBsData(DBs_used),
+        'UCC_data': UCC_data,
+        # Data for the table of close clusters
+        'close_data': close_table_data(UCC_data),
+        'ntbk_str': ntbk_str, 'entries_path': entries_path,
+        'N_membs_min': N_membs_min}
+
+
+# State of each worker process, set by 'init_worker'
+_worker_state = {}
+
+
+def init_worker(state):
+    """
+    Initialize the shared data once per worker process
+    """
+    # The plots are only written to file
+    matplotlib.use('Agg')
+    _worker_state.update(state)
+
+
+def process_entry(i):
+    """
+    Generate the files for a single cluster in a worker process
+    """
+    return make_cluster_files(i, _worker_state)
+
+
+def make_cluster_files(i, state):
+    """
+    Generate the entry, notebook and plot for the cluster in row 'i' of the
+    UCC. Returns None if all the files were generated, or the error raised
+    otherwise
+
+    state: data shared by all the clusters, see 'entries_state'
+    """
+    row = next(state['UCC_data'].iloc[[i]].itertuples(index=False))
+    # Only errors caused by the data of this cluster (missing or corrupt
+    # datafile, unknown DB entry or fname, values that can not be parsed)
+    # are stored. Any other error stops the run
+    try:
+        make_files(row, state)
+    except (OSError, KeyError, ValueError) as e:
+        return f"{type(e).__name__}: {e}"
+    return None
+
+
+def make_files(row, state):
+    """
+    """
+    fname0 = row.fnames.split(';')[0]
+
+    # if 'berkeley102' not in row['fnames']:
+    #     continue
+
+    Qfold = row.quad
+    # Folder name where the datafile is stored
+    files_path = "../" + Qfold + "/datafiles/"
+    # Folder names where the plot and notebook files will be stored
+    notb_path = "../" + Qfold + "/notebooks/"
+    plots_path = "../" + Qfold + "/plots/"
+
+    # Load datafile with members+field for this cluster, as stored by
+    # 'call_fastMP.save_cl_datafile'
+    df_cl = pd.read_parquet(files_path + fname0 + '.parquet')
+
+    # Split between members and field stars
+    df_membs, df_field = split_membs_field(df_cl, state['N_membs_min'])
+
+    # Make catalogue entry
+    DBs, DBs_i = row.DB.split(';'), row.DB_i.split(';')
+    fpars_table = fpars_in_lit(state['DBs_data'], DBs, DBs_i)
+    posit_table = positions_in_lit(state['DBs_data'], DBs, DBs_i)
+    close_table = close_cat_cluster(state['close_data'], row)
+    # Color used by the 'C3' classification
+    abcd_c = UCC_color(row.C3)
+
+    # All names for this cluster
+    cl_names = row.ID.split(';')
+    # The number of members (P>=0.5) and the center estimated from the
+    # members are those stored in the catalogue by 'call_fastMP'
+    ucc_entry.make_entry(
+        state['entries_path'], cl_names, Qfold, fname0, row.UCC_ID,
+        row.C1, row.C2, row.C3, abcd_c, int(row.N_50), row.GLON_m,
+        row.GLAT_m, row.RA_ICRS_m, row.DE_ICRS_m, row.plx_m, row.pmRA_m,
+        row.pmDE_m, row.Rv_m, fpars_table, posit_table, close_table)
+
+    # Make notebook
+    make_notebook(Qfold, notb_path, state['ntbk_str'], fname0)
+
+    # Make plot
+    ucc_plots.make_plot(plots_path, fname0, df_membs, df_field)
 
-        # if 'berkeley102' not in row['fnames']:
-        #     continue
-
-        Qfold = row['quad']
-        print(row['DB'], Qfold, fname0)
-        # Folder name where the datafile is stored
-        files_path = "../" + Qfold + "/datafiles/"
-        # Folder names where the plot and notebook files will be stored
-        notb_path = "../" + Qfold + "/notebooks/"
-        plots_path = "../" + Qfold + "/plots/"
-
-        # Load datafile with members+field for this cluster
-        df_cl = pd.read_csv(files_path + fname0 + '.csv.gz')
-
-        # Split between members and field stars
-        df_membs, df_field = split_membs_field(df_cl, N_membs_min)
-
-        # Make catalogue entry
-        DBs, DBs_i = row['DB'].split(';'), row['DB_i'].split(';')
-        fpars_table = fpars_in_lit(DBs_used, DBs_data, DBs, DBs_i)
-        posit_table = positions_in_lit(DBs_used, DBs_data, DBs, DBs_i)
-        close_table = close_cat_cluster(UCC_data, UCC_data['fnames'], row)
-        # Color used by the 'C1' classification
-        abcd_c = UCC_color(row['C1'])
-
-        # All names for this cluster
-        cl_names = row['ID'].split(';')
-        ucc_entry.make_entry(
-            entries_path, cl_names, Qfold, fname0, row['UCC_ID'],
-            row['C1'], row['C2'], abcd_c, Nmemb, lon_c, lat_c, ra_c, dec_c, plx_c, pmRA_c,
-            pmDE_c, RV_c, fpars_table, posit_table, close_table)
-
-        # Make notebook
-        make_notebook(Qfold, notb_path, ntbk_str, fname0)
-
-        # Make plot
-        ucc_plots.make_plot(plots_path, fname0, df_cl, N_membs_min)
-        breakpoint()
-        
 
 def split_membs_field(df_cl, N_membs_min, prob_min=0.5):
     """
+    Use the members mask stored in the datafile by 'call_fastMP'. Datafiles
+    generated before the mask was stored use the same selection
     """
-    probs_final = df_cl['probs']
-    msk = probs_final > prob_min
-    if msk.sum() < N_membs_min:
-        idx = np.argsort(probs_final)[::-1][:N_membs_min]
-        msk = np.full(len(probs_final), False)
-        msk[idx] = True
+    if 'membs' in df_cl.columns:
+        msk = df_cl['membs'].values
+    else:
+        msk = call_fastMP.membs_mask(df_cl['probs'], prob_min, N_membs_min)
     df_membs, df_field = df_cl[msk], df_cl[~msk]
 
     return df_membs, df_field
@@ -104,133 +219,88 @@ def UCC_color(abcd):
     return abcd_c
 
 
-def fpars_in_lit(DBs_used, DBs_data, DBs, DBs_i):
+def fpars_in_lit(DBs_data, DBs, DBs_i):
     """
     """
-
     # Select DBs with parameters and re-arrange them by year
     DBs_w_pars, DBs_i_w_pars = [], []
     for i, db in enumerate(DBs):
         # If this database contains any estimated fundamental parameters
-        pars_f = (np.array(DBs_used[db]['pars'].split(',')) != 'None').any()
-        if pars_f:
+        if DBs_data.has_pars[db]:
             DBs_w_pars.append(db)
             DBs_i_w_pars.append(DBs_i[i])
-    # Extract years
-    DBs_years = [int(_.split('_')[0][-2:]) for _ in DBs_w_pars]
-    # Sort
-    sort_idxs = np.argsort(DBs_years)
-    # Re-arrange
-    DBs_w_pars = np.array(DBs_w_pars)[sort_idxs]
-    DBs_i_w_pars = np.array(DBs_i_w_pars)[sort_idxs]
+    # Sort by year
+    sort_idxs = np.argsort([DBs_data.years[_] for _ in DBs_w_pars])
 
+    # Rows are formatted once for each DB
     txt = ''
-    for i, db in enumerate(DBs_w_pars):
-
-        # # If this database contains any estimated fundamental parameters
-        # pars_f = (np.array(DBs_used[db]['pars'].split(',')) != 'None').any()
-        # if not pars_f:
-        #     continue
-
-        txt += '| '
-        # Full 'db' database
-        df = DBs_data[db]
-        # Add reference
-        txt += DBs_used[db]['ref'] + ' | `'
-        # Add non-nan parameters
-        for par in DBs_used[db]['pars'].split(','):
-            # Read parameter value from DB as string
-            if par != 'None':
-                par_v = str(df[par][int(DBs_i_w_pars[i])])
-                # Remove empty spaces if any
-                par_v = par_v.replace(' ', '')
-                try:
-                    if par_v != '' and par_v != 'nan':
-                        par_v = float(df[par][int(DBs_i_w_pars[i])])
-                    else:
-                        par_v = np.nan
-                    if not np.isnan(par_v):
-                        txt += par + '=' + str(round(par_v, 2)) + ', '
-                except:
-                    # DBs like SANTOS21 list more than 1 value for
-                    # parameter
-                    txt += par + '=' + par_v + ', '
-            else:
-                txt += '--=--, '
-        # Close row
-        txt = txt[:-2] + '` |\n'
+    for i in sort_idxs:
+        txt += DBs_data.pars_rows(DBs_w_pars[i])[int(DBs_i_w_pars[i])]
 
     # Remove final new line
-    if txt != '':
-        table = txt[:-1]
-    else:
-        table = ''
+    table = txt[:-1]
 
     return table
 
 
-def positions_in_lit(DBs_used, DBs_data, DBs, DBs_i):
+def positions_in_lit(DBs_data, DBs, DBs_i):
     """
     """
     # Re-arrange DBs by year
-    DBs_years = [int(_.split('_')[0][-2:]) for _ in DBs]
-    # Sort
-    sort_idxs = np.argsort(DBs_years)
-    # Re-arrange
-    DBs_sort = np.array(DBs)[sort_idxs]
-    DBs_i_sort = np.array(DBs_i)[sort_idxs]
+    sort_idxs = np.argsort([DBs_data.years[_] for _ in DBs])
 
+    # Rows are formatted once for each DB
     txt = ''
-    for i, db in enumerate(DBs_sort):
-        txt += '|'
-        # Full 'db' database
-        df = DBs_data[db]
-        # Add reference
-        txt += DBs_used[db]['ref'] + ' | '
-
-        # Add positions
-        for c in DBs_used[db]['pos'].split(','):
-            if c != 'None':
-                # Read position as string
-                pos_v = str(df[c][int(DBs_i_sort[i])])
-                # Remove empty spaces if any
-                pos_v = pos_v.replace(' ', '')
-                if pos_v != '' and pos_v != 'nan':
-                    txt += str(round(float(pos_v), 3)) + ' | '
-                else:
-                    txt += '--' + ' | '
-            else:
-                txt += '--' + ' | '
-        # Close row
-        txt = txt[:-2] + ' |\n'
+    for i in sort_idxs:
+        row = DBs_data.pos_rows(DBs[i])[int(DBs_i[i])]
+        if row is None:
+            raise ValueError(
+                f"could not convert the positions in {DBs[i]}, entry "
+                + f"{DBs_i[i]}, to float")
+        txt += row
 
     # Remove final new line
-    if txt != '':
-        table = txt[:-1]
-    else:
-        table = ''
+    table = txt[:-1]
 
     return table
 
 
-def close_cat_cluster(fMP_data, fMP_fnames, row):
+def close_table_data(UCC_data):
     """
+    Data used by 'close_cat_cluster', generated once for the entire
+    catalogue
+    """
+    # Map the first fname of each cluster to its (first) row
+    fname_idx = {}
+    for j, fnames in enumerate(UCC_data['fnames']):
+        fname_idx.setdefault(fnames.split(';')[0], j)
+
+    close_data = {
+        'fname_idx': fname_idx,
+        'name': [_.split(';')[0] for _ in UCC_data['ID']]}
+    for col in ('RA_ICRS', 'DE_ICRS', 'plx', 'pmRA', 'pmDE'):
+        close_data[col] = np.round(UCC_data[col].values, 3)
+
+    return close_data
+
+
+def close_cat_cluster(close_data, row):
+    """
+    close_data: generated by 'close_table_data'
     """
     close_table = ''
-    if str(row['dups_fnames']) == 'nan':
+    if str(row.dups_fnames) == 'nan':
         return close_table
 
-    fnames0 = [_.split(';')[0] for _ in fMP_fnames]
-
-    dups_fnames = row['dups_fnames'].split(';')
+    dups_fnames = row.dups_fnames.split(';')
 
     for i, fname in enumerate(dups_fnames):
         close_table += '|'
-        j = fnames0.index(fname)
-        name = fMP_data['ID'][j].split(';')[0]
+        j = close_data['fname_idx'][fname]
+        name = close_data['name'][j]
         close_table += f"[{name}](https://ucc.ar/_clusters/{fname}/) | "
 
-        ra, dec, plx, pmRA, pmDE = [round(fMP_data[_][j], 3) for _ in (
+        ra, dec, plx, pmRA, pmDE = [close_data[_][j] for _ in (
             'RA_ICRS', 'DE_ICRS', 'plx', 'pmRA', 'pmDE')]
         close_table += f"{ra} | "
         close_table += f"{dec} | "
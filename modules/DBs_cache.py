@@ -0,0 +1,188 @@
+
+import os
+import zlib
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+
+class DBsData:
+    """
+    Lazy access to the databases listed in 'all_dbs.json'. Each DB is read
+    on first access, with only the columns declared in its 'names', 'pars'
+    and 'pos' entries.
+
+    A parquet copy of each (column-projected) DB is stored in 'cache_folder'
+    and used as long as the modification time of the source CSV file does
+    not change
+
+    DBs_used: dictionary loaded from 'all_dbs.json'
+    """
+
+    def __init__(
+        self, DBs_used, dbs_folder='databases/', cache_folder=None
+    ):
+        self.DBs_used = DBs_used
+        self.dbs_folder = dbs_folder
+        if cache_folder is None:
+            cache_folder = dbs_folder + 'cache/'
+        self.cache_folder = cache_folder
+        self.data = {}
+        # Values and formatted rows extracted from each DB, see 'values()',
+        # 'pars_rows()', 'pos_rows()'
+        self.vals = {}
+        self.rows = {}
+
+        # Year of each DB, used to sort them
+        self.years = {db: int(db.split('_')[0][-2:]) for db in DBs_used}
+        # DBs that contain any estimated fundamental parameters
+        self.has_pars = {
+            db: (np.array(DBs_used[db]['pars'].split(',')) != 'None').any()
+            for db in DBs_used}
+
+    def __getitem__(self, db):
+        if db not in self.data:
+            self.data[db] = self.load(db)
+        return self.data[db]
+
+    def columns(self, db):
+        """
+        Columns used from this DB
+        """
+        cols = [self.DBs_used[db]['names']]
+        for key in ('pars', 'pos'):
+            cols += self.DBs_used[db][key].split(',')
+        # Remove 'None' and repeated entries, keeping the order
+        return list(dict.fromkeys(_ for _ in cols if _ != 'None'))
+
+    def load(self, db):
+        """
+        Read the DB from its cached copy, or from its CSV file if the copy
+        is missing or outdated
+        """
+        csv_file = self.dbs_folder + db + '.csv'
+        cols = self.columns(db)
+        # The cached copy is tied to the modification time of the CSV and to
+        # the columns used
+        mtime = os.stat(csv_file).st_mtime_ns
+        cols_id = zlib.crc32(','.join(cols).encode())
+        cache_file = self.cache_folder + f"{db}_{mtime}_{cols_id}.parquet"
+
+        if os.path.isfile(cache_file):
+            df = pd.read_parquet(cache_file)
+            # Missing values in text columns are read back as None
+            for col in df.columns[df.dtypes == object]:
+                df[col] = df[col].where(df[col].notna(), np.nan)
+            return df
+
+        # Columns listed in the JSON file but not present in the DB are
+        # ignored here (as when reading the full DB)
+        df = pd.read_csv(csv_file, usecols=lambda _: _ in cols)
+
+        # Replace the old copies of this DB
+        Path(self.cache_folder).mkdir(parents=True, exist_ok=True)
+        for old_file in Path(self.cache_folder).glob(f"{db}_*.parquet"):
+            if old_file.stem.rsplit('_', 2)[0] == db \
+                    and str(old_file) != str(Path(cache_file)):
+                old_file.unlink(missing_ok=True)
+        # Written to a temporary file first, so that other processes never
+        # read a partial copy
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        df.to_parquet(tmp_file, index=False)
+        os.replace(tmp_file, cache_file)
+
+        return df
+
+    def values(self, db, col):
+        """
+        Column 'col' of this DB as a float array. Empty and 'nan' entries are
+        stored as NaN.
+
+        Also returns an array with the entries (with empty spaces removed)
+        that could not be converted to float, and None elsewhere. Some DBs
+        like SANTOS21 list more than one value for a parameter
+        """
+        if (db, col) in self.vals:
+            return self.vals[(db, col)]
+
+        data = self[db][col]
+        txt = np.full(len(data), None, dtype=object)
+        if data.dtype.kind in 'biuf':
+            vals = data.values.astype(float)
+        else:
+            vals = np.full(len(data), np.nan)
+            for i, v in enumerate(data.values):
+                v_s = str(v).replace(' ', '')
+                if v_s == '' or v_s == 'nan':
+                    continue
+                try:
+                    vals[i] = float(v)
+                except ValueError:
+                    txt[i] = v_s
+
+        self.vals[(db, col)] = (vals, txt)
+        return vals, txt
+
+    def pars_rows(self, db):
+        """
+        Row of the fundamental parameters table for each entry in this DB
+        """
+        if (db, 'pars') in self.rows:
+            return self.rows[(db, 'pars')]
+
+        N = len(self[db])
+        rows = np.full(
+            N, '| ' + self.DBs_used[db]['ref'] + ' | `', dtype=object)
+        for par in self.DBs_used[db]['pars'].split(','):
+            if par == 'None':
+                rows += '--=--, '
+                continue
+            vals, txt = self.values(db, par)
+            col_txt = np.full(N, '', dtype=object)
+            # Add non-nan parameters
+            msk = ~np.isnan(vals)
+            col_txt[msk] = [
+                par + '=' + str(round(_, 2)) + ', '
+                for _ in vals[msk].tolist()]
+            msk = pd.notna(txt)
+            col_txt[msk] = [par + '=' + _ + ', ' for _ in txt[msk]]
+            rows += col_txt
+        # Close rows
+        rows = np.array([_[:-2] + '` |\n' for _ in rows], dtype=object)
+
+        self.rows[(db, 'pars')] = rows
+        return rows
+
+    def pos_rows(self, db):
+        """
+        Row of the positions table for each entry in this DB. Entries with a
+        position that can not be converted to float have no row (None)
+        """
+        if (db, 'pos') in self.rows:
+            return self.rows[(db, 'pos')]
+
+        N = len(self[db])
+        rows = np.full(
+            N, '|' + self.DBs_used[db]['ref'] + ' | ', dtype=object)
+        msk_bad = np.full(N, False)
+        for c in self.DBs_used[db]['pos'].split(','):
+            col_txt = np.full(N, '-- | ', dtype=object)
+            if c != 'None':
+                vals, txt = self.values(db, c)
+                vals = vals.copy()
+                # Entries with empty spaces within the value
+                for i in np.flatnonzero(pd.notna(txt)):
+                    try:
+                        vals[i] = float(txt[i])
+                    except ValueError:
+                        msk_bad[i] = True
+                msk = ~np.isnan(vals)
+                col_txt[msk] = [
+                    str(round(_, 3)) + ' | ' for _ in vals[msk].tolist()]
+            rows += col_txt
+        # Close rows
+        rows = np.array([_[:-2] + ' |\n' for _ in rows], dtype=object)
+        rows[msk_bad] = None
+
+        self.rows[(db, 'pos')] = rows
+        return rows
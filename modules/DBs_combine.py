@@ -1,10 +1,11 @@
 
+import warnings
 import numpy as np
+import pandas as pd
 from astropy.coordinates import SkyCoord
 import astropy.units as u
-from scipy.spatial.distance import cdist
 from string import ascii_lowercase
-from duplicates_id import duplicate_probs
+from .duplicates_id import duplicate_probs, coords_tree
 
 
 """
@@ -144,16 +145,35 @@ def rm_name_dups(names_l):
     return ';'.join(list(dict.fromkeys(names_l)))
 
 
-def get_matches_new_DB(df_comb, new_DB_fnames):
+def get_fnames_index(df_comb):
+    """
+    Inverted index that maps each fname in the combined DB to the (first)
+    row where it is listed. Build it once and pass it to
+    'get_matches_new_DB' when matching several DBs against the same
+    combined DB
+    """
+    fnames_idx = {}
+    for j, old_cl in enumerate(df_comb['fnames']):
+        for name_old in old_cl.split(';'):
+            # Keep the first row where the fname appears
+            fnames_idx.setdefault(name_old, j)
+    return fnames_idx
+
+
+def get_matches_new_DB(df_comb, new_DB_fnames, fnames_idx=None):
     """
     Get cluster matches for the new DB being added to the combined DB
+
+    fnames_idx: optional fname-->row index generated by 'get_fnames_index'
     """
+    if fnames_idx is None:
+        fnames_idx = get_fnames_index(df_comb)
+
     def match_fname(new_cl):
         for name_new in new_cl:
-            for j, old_cl in enumerate(df_comb['fnames']):
-                for name_old in old_cl.split(';'):
-                    if name_new == name_old:
-                        return j
+            j = fnames_idx.get(name_new)
+            if j is not None:
+                return j
         return None
 
     db_matches = []
@@ -164,10 +184,30 @@ def get_matches_new_DB(df_comb, new_DB_fnames):
     return db_matches
 
 
+def get_DB_rows(df_comb, DB_IDs):
+    """
+    Rows (positions) of the combined DB that list any of the DBs in 'DB_IDs'
+    in their 'DB' column. The IDs must match exactly, i.e.: 'HE22' does not
+    select the 'HE22_1' entries
+
+    DB_IDs: DB ID or list of DB IDs
+    """
+    if isinstance(DB_IDs, str):
+        DB_IDs = [DB_IDs]
+    DBs = pd.Series(df_comb['DB'].values).str.split(';').explode()
+    return np.unique(DBs.index[DBs.isin(DB_IDs)])
+
+
 def combine_new_DB(
     new_DB_ID, df_comb, df_new, json_pars, new_DB_fnames, db_matches, sep
 ):
     """
+    Combine the new DB with the 'old' combined DB. Returns a dataframe with
+    the same columns as 'df_comb' and one row per cluster in the new DB,
+    along with the indexes in 'df_comb' of the clusters present in the new DB
+
+    Columns not estimated from the new DB (UCC_ID, fastMP values, etc) are
+    copied from 'df_comb' for matched clusters and are 'nan' for new ones
     """
     cols = []
     for v in json_pars['pos'].split(','):
@@ -177,185 +217,151 @@ def combine_new_DB(
     # Remove Rv column
     ra_c, dec_c, plx_c, pmra_c, pmde_c = cols[:-1]
 
-    new_db_dict = {_: [] for _ in df_comb.keys()}
-    idx_rm_comb_db = []
-    for i, new_cl in enumerate(new_DB_fnames):
-
-        row_n = df_new.iloc[i]
-
-        new_names = row_n[json_pars['names']].split(sep)
-        new_names = [_.strip() for _ in new_names]
-        new_names = ';'.join(new_names)
-
-        # Coordinates for this cluster in the new DB
-        plx_n, pmra_n, pmde_n = np.nan, np.nan, np.nan
-        ra_n, dec_n = row_n[ra_c], row_n[dec_c]
-        if plx_c is not None:
-            plx_n = row_n[plx_c]
-        if pmra_c is not None:
-            pmra_n = row_n[pmra_c]
-        if pmde_c is not None:
-            pmde_n = row_n[pmde_c]
-
-        # Index of the match for this new cluster in the old DB (if any)
-        db_match_j = db_matches[i]
-
-        # If the cluster is already present in the 'old' combined DB
-        if db_match_j is not None:
-            # Store indexes in old DB of clusters present in new DB
-            idx_rm_comb_db.append(db_match_j)
-
-            # Identify row in old DB where this match is
-            row = df_comb.iloc[db_match_j]
-
-            # Combine old data with that of the new matched cluster
-            ra_n = np.nanmedian([row['RA_ICRS'], ra_n])
-            dec_n = np.nanmedian([row['DE_ICRS'], dec_n])
-            if not np.isnan([row['plx'], plx_n]).all():
-                plx_n = np.nanmedian([row['plx'], plx_n])
-            if not np.isnan([row['pmRA'], pmra_n]).all():
-                pmra_n = np.nanmedian([row['pmRA'], pmra_n])
-            if not np.isnan([row['pmDE'], pmde_n]).all():
-                pmde_n = np.nanmedian([row['pmDE'], pmde_n])
-
-            # Add new DB information
-            DB_ID = row['DB'] + ';' + new_DB_ID
-            DB_i = row['DB_i'] + ';' + str(i)
-            # Add name in new DB
-            ID = row['ID'] + ';' + new_names
-            # Add fnames in new DB
-            fnames = row['fnames'] + ';' + ';'.join(new_cl)
-
-            # Copy values from the 'old' DB for these columns
-            UCC_ID = row['UCC_ID']
-            quad = row['quad']
-            dups_fnames = row['dups_fnames']
-            r_50 = row['r_50']
-            N_50 = row['N_50']
-            Nmembs = row['Nmembs']
-            fixed_cent = row['fixed_cent']
-            cent_flags = row['cent_flags']
-            C1 = row['C1']
-            C2 = row['C2']
-            GLON_m = row['GLON_m']
-            GLAT_m = row['GLAT_m']
-            RA_ICRS_m = row['RA_ICRS_m']
-            DE_ICRS_m = row['DE_ICRS_m']
-            plx_m = row['plx_m']
-            pmRA_m = row['pmRA_m']
-            pmDE_m = row['pmDE_m']
-            Rv_m = row['Rv_m']
-            N_Rv = row['N_Rv']
-
-        else:
-            # The cluster is not present in the 'old' combined DB
-            DB_ID = new_DB_ID
-            DB_i = str(i)
-            ID = new_names
-            fnames = ';'.join(new_cl)
-
-            # These values will be assigned later on for these new clusters
-            UCC_ID = np.nan
-            quad = np.nan
-            dups_fnames = np.nan
-
-            # These values will be assigned by the 'call_fastMP' module
-            r_50 = np.nan
-            N_50 = np.nan
-            Nmembs = np.nan
-            fixed_cent = np.nan
-            cent_flags = np.nan
-            C1 = np.nan
-            C2 = np.nan
-            GLON_m = np.nan
-            GLAT_m = np.nan
-            RA_ICRS_m = np.nan
-            DE_ICRS_m = np.nan
-            plx_m = np.nan
-            pmRA_m = np.nan
-            pmDE_m = np.nan
-            Rv_m = np.nan
-            N_Rv = np.nan
-
-        new_db_dict['DB'].append(DB_ID)
-        new_db_dict['DB_i'].append(DB_i)
-        # Remove duplicates
-        if ';' in ID:
-            ID = ';'.join(list(dict.fromkeys(ID.split(';'))))
-        new_db_dict['ID'].append(ID)
-        lon_n, lat_n = radec2lonlat(ra_n, dec_n)
-        new_db_dict['RA_ICRS'].append(round(ra_n, 4))
-        new_db_dict['DE_ICRS'].append(round(dec_n, 4))
-        new_db_dict['GLON'].append(lon_n)
-        new_db_dict['GLAT'].append(lat_n)
-        new_db_dict['plx'].append(plx_n)
-        new_db_dict['pmRA'].append(pmra_n)
-        new_db_dict['pmDE'].append(pmde_n)
-        # Remove duplicates
-        if ';' in fnames:
-            fnames = ';'.join(list(dict.fromkeys(fnames.split(';'))))
-        new_db_dict['fnames'].append(fnames)
-        new_db_dict['UCC_ID'].append(UCC_ID)
-        new_db_dict['quad'].append(quad)
-        new_db_dict['dups_fnames'].append(dups_fnames)
-        new_db_dict['r_50'].append(r_50)
-        new_db_dict['N_50'].append(N_50)
-        new_db_dict['Nmembs'].append(Nmembs)
-        new_db_dict['fixed_cent'].append(fixed_cent)
-        new_db_dict['cent_flags'].append(cent_flags)
-        new_db_dict['C1'].append(C1)
-        new_db_dict['C2'].append(C2)
-        new_db_dict['GLON_m'].append(GLON_m)
-        new_db_dict['GLAT_m'].append(GLAT_m)
-        new_db_dict['RA_ICRS_m'].append(RA_ICRS_m)
-        new_db_dict['DE_ICRS_m'].append(DE_ICRS_m)
-        new_db_dict['plx_m'].append(plx_m)
-        new_db_dict['pmRA_m'].append(pmRA_m)
-        new_db_dict['pmDE_m'].append(pmDE_m)
-        new_db_dict['Rv_m'].append(Rv_m)
-        new_db_dict['N_Rv'].append(N_Rv)
+    N_new = len(new_DB_fnames)
+    # Index of the match for each new cluster in the old DB (-1 if no match)
+    idx_match = np.array(
+        [-1 if _ is None else _ for _ in db_matches], dtype=int)
+    msk_match = idx_match >= 0
+    # Store indexes in old DB of clusters present in new DB
+    idx_rm_comb_db = list(idx_match[msk_match])
+
+    # Copy all values from the 'old' DB for the matched clusters. Rows with
+    # no match (index -1) are filled with 'nan'
+    df_comb = df_comb.reset_index(drop=True)
+    df_new_db = df_comb.reindex(idx_match).reset_index(drop=True)
+
+    # Coordinates for the clusters in the new DB
+    def new_col(c):
+        if c is None:
+            return np.full(N_new, np.nan)
+        return df_new[c].values.astype(float)
+
+    # Combine old data with that of the new matched clusters
+    with warnings.catch_warnings():
+        # All-nan pairs return 'nan'
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for c_old, c_new in (
+            ('RA_ICRS', ra_c), ('DE_ICRS', dec_c), ('plx', plx_c),
+            ('pmRA', pmra_c), ('pmDE', pmde_c)
+        ):
+            vals_new = new_col(c_new)
+            vals_old = df_new_db[c_old].values.astype(float)
+            vals_new[msk_match] = np.nanmedian(
+                [vals_old[msk_match], vals_new[msk_match]], 0)
+            df_new_db[c_old] = vals_new
+
+    lon_all, lat_all = radec2lonlat(
+        df_new_db['RA_ICRS'], df_new_db['DE_ICRS'])
+    df_new_db['RA_ICRS'] = np.round(df_new_db['RA_ICRS'].values, 4)
+    df_new_db['DE_ICRS'] = np.round(df_new_db['DE_ICRS'].values, 4)
+    df_new_db['GLON'], df_new_db['GLAT'] = lon_all, lat_all
+
+    # Names and fnames in new DB
+    new_names = [
+        ';'.join([_.strip() for _ in names.split(sep)])
+        for names in df_new[json_pars['names']].values]
+    new_fnames = [';'.join(_) for _ in new_DB_fnames]
+
+    def add_new(col, vals_new):
+        """Append new DB values to those of matched clusters"""
+        vals = []
+        for old_v, new_v, is_match in zip(
+                df_new_db[col].values, vals_new, msk_match):
+            if is_match:
+                new_v = old_v + ';' + new_v
+            vals.append(new_v)
+        return vals
+
+    def rm_dups(vals):
+        return [';'.join(list(dict.fromkeys(_.split(';')))) for _ in vals]
+
+    # Add new DB information
+    df_new_db['DB'] = add_new('DB', [new_DB_ID] * N_new)
+    df_new_db['DB_i'] = add_new('DB_i', [str(_) for _ in range(N_new)])
+    # Add name and fnames in new DB, removing duplicates
+    df_new_db['ID'] = rm_dups(add_new('ID', new_names))
+    df_new_db['fnames'] = rm_dups(add_new('fnames', new_fnames))
 
     # Remove duplicates of the kind: Berkeley 102, Berkeley102,
     # Berkeley_102; keeping only the name with the space
-    for q, names in enumerate(new_db_dict['ID']):
+    for q, names in enumerate(df_new_db['ID']):
         names_l = names.split(';')
         names = rm_name_dups(names_l)
 
-    return new_db_dict, idx_rm_comb_db
+    return df_new_db, idx_rm_comb_db
 
 
 def radec2lonlat(ra, dec):
+    """
+    Transform equatorial coordinates to galactic. Accepts single values or
+    arrays, which are transformed in a single call
+    """
+    ra, dec = np.asarray(ra, dtype=float), np.asarray(dec, dtype=float)
     gc = SkyCoord(ra=ra * u.degree, dec=dec * u.degree)
     lb = gc.transform_to('galactic')
     lon, lat = lb.l.value, lb.b.value
     return np.round(lon, 4), np.round(lat, 4)
 
 
+class UCCIDAllocator:
+    """
+    Assign UCC IDs to new clusters. The IDs already taken are stored in a set
+    so that collisions are checked in constant time
+    """
+
+    def __init__(self, ucc_ids_old):
+        self.ucc_ids = set(ucc_ids_old)
+
+    def assign(self, glon, glat):
+        """
+        Assign (and reserve) UCC IDs for arrays of GLON, GLAT coordinates.
+        Clusters are processed in order, so collisions between the new
+        clusters are resolved as if they were assigned one at a time
+        """
+        ucc_ids_new = []
+        for ucc_id in format_UCC_ids(glon, glat):
+            ucc_id = free_UCC_id(ucc_id, self.ucc_ids)
+            self.ucc_ids.add(ucc_id)
+            ucc_ids_new.append(ucc_id)
+        return ucc_ids_new
+
+
 def assign_UCC_ids(glon, glat, ucc_ids_old):
     """
     Format: UCC GXXX.X+YY.Y
     """
-    ll = trunc(np.array([glon, glat]).T)
-    lon, lat = str(ll[0]), str(ll[1])
+    ucc_id = format_UCC_ids([glon], [glat])[0]
+    return free_UCC_id(ucc_id, ucc_ids_old)
+
+
+def format_UCC_ids(glon, glat):
+    """
+    Format: UCC GXXX.X+YY.Y
+
+    Accepts arrays of coordinates and returns a list of UCC IDs, with no
+    check for collisions
+    """
+    if len(glon) == 0:
+        return []
+    lon, lat = trunc(np.array([glon, glat], dtype=float))
+    lon_s, lat_s = lon.astype(str), lat.astype(str)
+
+    lon_s = np.char.add(
+        np.select([lon < 10, lon < 100], ['00', '0'], ''), lon_s)
 
-    if ll[0] < 10:
-        lon = '00' + lon
-    elif ll[0] < 100:
-        lon = '0' + lon
+    lat_s = np.select(
+        [lat >= 10, lat > 0, lat == 0, lat >= -10],
+        [np.char.add('+', lat_s), np.char.add('+0', lat_s),
+         np.char.add('+0', np.char.replace(lat_s, '-', '')),
+         np.char.add('-0', np.char.lstrip(lat_s, '-'))], lat_s)
 
-    if ll[1] >= 10:
-        lat = '+' + lat
-    elif ll[1] < 10 and ll[1] > 0:
-        lat = '+0' + lat
-    elif ll[1] == 0:
-        lat = '+0' + lat.replace('-', '')
-    elif ll[1] < 0 and ll[1] >= -10:
-        lat = '-0' + lat[1:]
-    elif ll[1] < -10:
-        pass
+    return np.char.add(np.char.add('UCC G', lon_s), lat_s).tolist()
 
-    ucc_id = 'UCC G' + lon + lat
 
+def free_UCC_id(ucc_id, ucc_ids_old):
+    """
+    Add a letter to the end of the UCC ID if it is already taken
+    """
     i = 0
     while True:
         if i > 25:
@@ -412,36 +418,29 @@ def dups_identify(df, prob_cut=0.5, Nmax=3):
     """
     Find the closest clusters to all clusters
     """
-    x, y = df['GLON'], df['GLAT']
-    coords = np.array([x, y]).T
-    # Find the distances to all clusters, for all clusters
-    dist = cdist(coords, coords)
-    pmRA, pmDE, plx = df['pmRA'], df['pmDE'], df['plx']
+    x, y = df['GLON'].values, df['GLAT'].values
+    pmRA, pmDE, plx = df['pmRA'].values, df['pmDE'].values, df['plx'].values
+    # Spatial index over (GLON, GLAT), periodic in GLON
+    tree = coords_tree(x, y)
 
-    dups_fnames, dups_probs = [], []
-    for i, dists_i in enumerate(dist):
+    # Only process relatively close clusters
+    rad_max = Nmax * max_coords_rad(plx)
+    idx_close = tree.query_ball_point(tree.data, rad_max, return_sorted=True)
 
-        # Only process relatively close clusters
-        rad_max = Nmax * max_coords_rad(plx[i])
-        msk_rad = dists_i <= rad_max
-        idx_j = np.arange(0, len(dists_i))
-        dists_i_msk = dists_i[msk_rad]
-        j_msk = idx_j[msk_rad]
+    dups_fnames, dups_probs = [], []
+    for i, j_msk in enumerate(idx_close):
+        # Skip itself
+        j_msk = np.array([j for j in j_msk if j != i], dtype=int)
 
         dups_fname_i, dups_prob_i = [], []
-        for k, d_ij in enumerate(dists_i_msk):
-            j = j_msk[k]
-            # Skip itself
-            if j == i:
-                continue
-
-            # Fetch duplicated flag and probability for the i,j clusters
-            dup_prob = duplicate_probs(x, y, pmRA, pmDE, plx, i, j)
-            if dup_prob >= prob_cut:
-                # print(df['fnames'][i], df['fnames'][j], dup_prob)
-                # Store just the first fname
-                dups_fname_i.append(df['fnames'][j].split(';')[0])
-                dups_prob_i.append(str(dup_prob))
+        if len(j_msk) > 0:
+            # Fetch duplicated probabilities for the i,j clusters
+            dup_probs = duplicate_probs(x, y, pmRA, pmDE, plx, i, j_msk)
+            for k, dup_prob in enumerate(dup_probs):
+                if dup_prob >= prob_cut:
+                    # Store just the first fname
+                    dups_fname_i.append(df['fnames'][j_msk[k]].split(';')[0])
+                    dups_prob_i.append(str(dup_prob))
 
         if dups_fname_i:
             dups_fname_i = ";".join(dups_fname_i)
@@ -455,25 +454,14 @@ def dups_identify(df, prob_cut=0.5, Nmax=3):
     return dups_fnames, dups_probs
 
 
-def max_coords_rad(plx_i):
-    """
-    Parallax dependent maximum radius in arcmin
-    """
-    if np.isnan(plx_i):
-        rad = 5
-    elif plx_i >= 4:
-        rad = 20
-    elif 3 <= plx_i and plx_i < 4:
-        rad = 15
-    elif 2 <= plx_i and plx_i < 3:
-        rad = 10
-    elif 1.5 <= plx_i and plx_i < 2:
-        rad = 7.5
-    elif 1 <= plx_i and plx_i < 1.5:
-        rad = 5
-    elif .5 <= plx_i < 1:
-        rad = 2.5
-    elif plx_i < .5:
-        rad = 1.5
+def max_coords_rad(plx):
+    """
+    Parallax dependent maximum radius in arcmin. Accepts a single value
+    or an array of parallaxes
+    """
+    plx = np.asarray(plx, dtype=float)
+    rad = np.select(
+        (np.isnan(plx), plx >= 4, plx >= 3, plx >= 2, plx >= 1.5, plx >= 1,
+         plx >= .5), (5, 20, 15, 10, 7.5, 5, 2.5), 1.5)
     rad = rad / 60  # To degrees
-    return rad
+    return rad[()]
@@ -1,21 +1,42 @@
 
+import os
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import importlib
+import json
+import zlib
 import numpy as np
 import pandas as pd
 from scipy import spatial
 from scipy.stats import gaussian_kde
 from scipy.special import loggamma
-from scipy.integrate import quad
-import warnings
+from scipy.integrate import trapezoid
 import csv
 
 
 def run(
     fastMP, G3Q, frames_path, frames_data, df_UCC, df_gcs, UCC_cat, out_path,
-    clusters_list, max_mag=20
+    clusters_list, max_mag=20, frames_cache_mb=2000, N_workers=1,
+    resume=False, seed=12345, float32=False
 ):
     """
     max_mag: maximum magnitude to retrieve
+    frames_cache_mb: memory ceiling (in Mb) for the Gaia frames kept in memory
+    and shared between clusters. This is the total for all the processes:
+    each worker gets 'frames_cache_mb // N_workers'. If 0, or if this is
+    smaller than a typical frame part (see 'G3Q.frame_part_mb'), no frames
+    are cached and only the rows required by each cluster are read from the
+    (parquet) frames
+    N_workers: number of processes used to process the clusters. If 1, the
+    clusters are processed serially in this process. Otherwise each worker
+    uses a single thread for the KD-tree queries
+    resume: if True, skip the clusters already stored in the results journal
+    of a previous (interrupted) run. Otherwise a new journal is started
+    seed: base seed for the random numbers used in the classification. Each
+    cluster uses its own seed, derived from this one and its UCC_ID, so the
+    results do not depend on the order in which the clusters are processed
+    float32: store most of the Gaia data as float32 to reduce the memory
+    used by large frames, see 'G3Q.run'
     """
 
     # Create output folders if not present
@@ -25,145 +46,349 @@ def run(
             Path(out_path + Qfold + '/datafiles/').mkdir(
                 parents=True, exist_ok=True)
 
-    # Parameters used to search for close-by clusters
-    xys = np.array([
-        df_UCC['GLON'].values, df_UCC['GLAT'].values]).T
-    tree = spatial.cKDTree(xys)
+    # The results for each cluster are appended to this file as soon as they
+    # are obtained. In parallel mode each worker uses its own file, see
+    # 'journal_files'
+    journal_file = UCC_cat.replace('.csv', '') + '_journal.jsonl'
+    UCC_IDs_done = set()
+    if resume and journal_files(journal_file):
+        records = read_journal(journal_file)
+        UCC_IDs_done = set(_['UCC_ID'] for _ in records)
+        # Merge the journals into a single one without the incomplete last
+        # lines (if any), so that new results are not appended to them
+        with open(journal_file, 'w') as f_journal:
+            for rec in records:
+                f_journal.write(json.dumps(rec) + '\n')
+        for file in journal_files(journal_file)[1:]:
+            file.unlink()
+        print(f"Resuming run, {len(UCC_IDs_done)} clusters already processed")
+    else:
+        # Start a new journal
+        for file in journal_files(journal_file):
+            file.unlink()
+        open(journal_file, 'w').close()
+
+    clusters = [
+        (index, cl) for index, cl in clusters_list.iterrows()
+        if cl['UCC_ID'] not in UCC_IDs_done]
+    # The frames cache memory and the CPU cores are split between the
+    # workers
+    N_threads = -1
+    if N_workers > 1:
+        frames_cache_mb = frames_cache_mb // N_workers
+        N_threads = 1
+    if frames_cache_mb > 0:
+        # A cache that can not store a whole part of a frame would read it
+        # unfiltered on every query
+        part_mb = G3Q.frame_part_mb(frames_path, frames_data['filename'])
+        if part_mb is not None and frames_cache_mb < part_mb:
+            print(f"Frames cache of {frames_cache_mb} Mb per process is "
+                  + f"smaller than a frame part ({part_mb:.0f} Mb), the "
+                  + "frames are not cached")
+            frames_cache_mb = 0
+    state_args = (
+        fastMP, G3Q.__name__, frames_path, frames_data, df_UCC, df_gcs,
+        out_path, max_mag, frames_cache_mb, seed, float32, N_threads)
+
+    if N_workers > 1:
+        # Each worker processes chunks of neighbouring clusters, so that
+        # clusters that share Gaia frames hit the same worker's cache. The
+        # workers store each result in their own journal
+        chunks = chunk_clusters(clusters, N_workers * 4)
+        with ProcessPoolExecutor(
+            N_workers, initializer=init_worker,
+            initargs=(journal_file, *state_args)
+        ) as executor:
+            futures = [executor.submit(process_chunk, _) for _ in chunks]
+            cache_counts = {}
+            for future in as_completed(futures):
+                pid, counts = future.result()
+                # The counts of each worker are cumulative
+                cache_counts[pid] = max(cache_counts.get(pid, counts), counts)
+        if frames_cache_mb > 0 and cache_counts:
+            hits, misses = np.sum(list(cache_counts.values()), axis=0)
+            print(f"Frames cache ({len(cache_counts)} workers): {hits} "
+                  + f"hits, {misses} misses")
+    else:
+        state = cluster_state(*state_args)
+        with open(journal_file, 'a') as f_journal:
+            for index, cl in clusters:
+                cl_result = process_cluster(index, cl, state)
+                write_journal(f_journal, cl['UCC_ID'], cl_result)
+        if state['frames_cache'] is not None:
+            print(state['frames_cache'].stats())
+
+    records = read_journal(journal_file)
+    N_refit = sum(_.get('N_refit', 0) for _ in records)
+    print(f"fastMP re-fitted with fixed centers for {N_refit} of "
+          + f"{len(records)} clusters")
 
-    index_all, r50_all, N_fixed_all, N_survived_all, fixed_centers_all,\
-        cent_flags_all, C1_all, C2_all, C3_all, quad_all, membs_cents_all,\
-        N_ex_cls_all = [[] for _ in range(12)]
-    for index, cl in clusters_list.iterrows():
+    # Load again in case it was updates while the script run
+    df_UCC = pd.read_csv(UCC_cat)
+    # Update the values for all the processed clusters
+    df_UCC = update_UCC(df_UCC, records)
 
-        print(f"*** {index} Processing {cl['ID']} with fastMP...")
-        print(cl['GLON'], cl['GLAT'], cl['pmRA'], cl['pmDE'], cl['plx'])
+    df_UCC.to_csv(UCC_cat, na_rep='nan', index=False,
+                  quoting=csv.QUOTE_NONNUMERIC)
 
-        if 'hsc46' not in cl['fnames']:
-            continue
 
-        # Generate frame
-        box_s, plx_min = get_frame(cl)
+def write_journal(f_journal, UCC_ID, cl_result):
+    """
+    Append the results for a processed cluster to the journal
+    """
+    # Numpy scalars are converted to Python types
+    line = json.dumps(
+        {'UCC_ID': UCC_ID, **cl_result}, default=lambda _: _.item())
+    f_journal.write(line + '\n')
+    f_journal.flush()
+
 
-        fname0 = cl['fnames'].split(';')[0]
-        # These clusters are extended require a larger frame
-        if fname0.startswith('ubc'):
-            box_s *= 3
+def journal_files(journal_file):
+    """
+    Existing journal files: the main one (written in serial mode and when a
+    run is resumed) followed by those written by each worker process, named
+    '<journal>_<pid>.jsonl'
+    """
+    journal_file = Path(journal_file)
+    files = sorted(journal_file.parent.glob(journal_file.stem + '_*.jsonl'))
+    if journal_file.is_file():
+        files = [journal_file] + files
+    return files
 
-        # Get close clusters coords
-        centers_ex = get_close_cls(
-            cl['GLON'], cl['GLAT'], tree, box_s, index, df_UCC,
-            cl['dups_fnames'], df_gcs)
 
-        if np.isnan(cl['N_ex_cls']):
-            pass
-        elif int(cl['N_ex_cls']) == len(centers_ex):
-            print("No difference in extra clusters. Skip")
+def read_journal(journal_file):
+    """
+    Read the results stored in all the journal files, see 'journal_files'.
+    An incomplete last line (left by an interrupted run) is ignored
+    """
+    records = []
+    for file in journal_files(journal_file):
+        with open(file) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    pass
+    return records
+
+
+def update_UCC(df_UCC, records):
+    """
+    Update the UCC with the results of the processed clusters, one column at
+    a time. If a cluster is stored more than once, the last values are used
+    """
+    if len(records) == 0:
+        return df_UCC
+    df_res = pd.DataFrame(records).drop_duplicates('UCC_ID', keep='last')
+
+    # Rows in the UCC of the processed clusters
+    UCC_rows = pd.Series(df_UCC.index, index=df_UCC['UCC_ID'].values)
+    df_res = df_res[df_res['UCC_ID'].isin(UCC_rows.index)]
+    df_res.index = UCC_rows[df_res['UCC_ID'].values].values
+    msk = df_UCC.index.isin(df_res.index)
+
+    for col in df_res.columns:
+        # The number of re-fits is only stored in the journal
+        if col in ('UCC_ID', 'N_refit'):
             continue
+        vals = df_res[col].reindex(df_UCC.index)
+        col_UCC = df_UCC[col]
+        # Numeric columns keep their type, anything else is stored as object
+        if not (_is_number(col_UCC) and _is_number(vals)):
+            col_UCC = col_UCC.astype(object)
+        df_UCC[col] = col_UCC.where(~msk, vals)
 
-        index_all.append(index)
-        N_ex_cls_all.append(len(centers_ex))
-
-        # Request data
-        data = G3Q.run(frames_path, frames_data, cl['RA_ICRS'], cl['DE_ICRS'],
-                       box_s, plx_min, max_mag)
-        # Store full file
-        # # data.to_csv(out_path + fname0 + "_full.csv", index=False)
-        # data.to_parquet(out_path + fname0 + "_full.parquet", index=False)
-        # Read from file
-        # data = pd.read_csv(out_path + fname0 + "_full.csv")
-        # data.to_parquet(out_path + fname0 + "_full.parquet", index=False)
-        # data = pd.read_parquet(out_path + fname0 + "_full.parquet")
-        # data.to_csv(out_path + fname0 + "_full.csv", index=False)
-
-        # Extract center coordinates
-        xy_c, vpd_c, plx_c = (cl['GLON'], cl['GLAT']), None, None
-        if not np.isnan(cl['pmRA']):
-            vpd_c = (cl['pmRA'], cl['pmDE'])
-        if not np.isnan(cl['plx']):
-            plx_c = cl['plx']
-
-        fix_N_clust = False
-        fixed_centers = False
-        if vpd_c is None and plx_c is None:
-            fixed_centers = True
+    return df_UCC
 
-        # Generate input data array for fastMP
-        X = np.array([
-            data['GLON'].values, data['GLAT'].values, data['pmRA'].values,
-            data['pmDE'].values, data['Plx'].values, data['e_pmRA'].values,
-            data['e_pmDE'].values, data['e_Plx'].values])
 
-        # Process with fastMP
-        while True:
-            print("Fixed centers?:", fixed_centers)
-            probs_all, N_survived = fastMP(
-                xy_c=xy_c, vpd_c=vpd_c, plx_c=plx_c, centers_ex=centers_ex,
-                fixed_centers=fixed_centers, fix_N_clust=fix_N_clust).fit(X)
+def _is_number(col):
+    """Numeric (and not boolean) column"""
+    return col.dtype.kind in 'iuf'
 
-            bad_center = check_centers(
-                *X[:5, :], xy_c, vpd_c, plx_c, probs_all)
 
-            if bad_center == '000' or fixed_centers is True:
-                break
-            else:
-                # print("Re-run with fixed_centers = True")
-                fixed_centers = True
+def cluster_state(
+    fastMP, G3Q_name, frames_path, frames_data, df_UCC, df_gcs, out_path,
+    max_mag, frames_cache_mb, seed, float32, N_threads
+):
+    """
+    Data shared by all the clusters processed by a single process
 
-        fixed_centers_all.append(fixed_centers)
-        N_fixed_all.append(fix_N_clust)
-        N_survived_all.append(int(N_survived))
+    N_threads: number of threads used by the KD-tree queries (-1 for all
+    the cores)
+    """
+    G3Q = importlib.import_module(G3Q_name)
 
-        bad_center = check_centers(*X[:5, :], xy_c, vpd_c, plx_c, probs_all)
-        cent_flags_all.append(bad_center)
-        print("Nsurv={}, (P>0.5)={}, cents={}".format(
-              N_survived, (probs_all > 0.5).sum(), bad_center))
+    # Parameters used to search for close-by clusters
+    cls_data = close_cls_data(df_UCC, df_gcs)
 
-        df_comb, df_membs, df_field, r_50, xy_c, vpd_c, plx_c =\
-            split_membs_field(data, probs_all)
-        r50_all.append(r_50)
+    # Decoded Gaia frames shared by all the clusters
+    frames_cache = None
+    if frames_cache_mb > 0:
+        frames_cache = G3Q.FramesCache(frames_cache_mb)
 
-        C1, C2, C3 = get_classif(df_membs, df_field)
-        C1_all.append(C1)
-        C2_all.append(C2)
-        C3_all.append(C3)
+    return {
+        'fastMP': fastMP, 'G3Q': G3Q, 'frames_path': frames_path,
+        'frames_data': frames_data, 'out_path': out_path,
+        'max_mag': max_mag, 'cls_data': cls_data,
+        'frames_cache': frames_cache, 'seed': seed, 'float32': float32,
+        'N_threads': N_threads}
 
-        N_50, lon, lat, ra, dec, plx, pmRA, pmDE, RV, N_Rv = extract_cl_data(
-            df_membs)
-        membs_cents_all.append([
-            N_50, lon, lat, ra, dec, plx, pmRA, pmDE, RV, N_Rv])
 
-        # Write member stars for cluster and some field
-        save_cl_datafile(cl, df_comb, out_path)
+def cluster_rng(seed, UCC_ID):
+    """
+    Random numbers generator for a single cluster
+    """
+    # 'hash()' is not used as it changes between Python processes
+    return np.random.default_rng([seed, zlib.crc32(UCC_ID.encode())])
 
-        print(f"*** Cluster {cl['ID']} processed with fastMP\n")
 
-    membs_cents_all = np.array(membs_cents_all).T
-    # Load again in case it was updates while the script run
-    df_UCC = pd.read_csv(UCC_cat)
-    # Update these values for all the processed clusters
-    for i, idx in enumerate(index_all):
-        df_UCC.at[idx, 'r_50'] = r50_all[i]
-        df_UCC.at[idx, 'N_fixed'] = N_fixed_all[i]
-        df_UCC.at[idx, 'N_membs'] = int(N_survived_all[i])
-        df_UCC.at[idx, 'fixed_cent'] = fixed_centers_all[i]
-        df_UCC.at[idx, 'cent_flags'] = cent_flags_all[i]
-        df_UCC.at[idx, 'C1'] = C1_all[i]
-        df_UCC.at[idx, 'C2'] = C2_all[i]
-        df_UCC.at[idx, 'C3'] = C3_all[i]
-        df_UCC.at[idx, 'N_50'] = membs_cents_all[0][i]
-        df_UCC.at[idx, 'GLON_m'] = membs_cents_all[1][i]
-        df_UCC.at[idx, 'GLAT_m'] = membs_cents_all[2][i]
-        df_UCC.at[idx, 'RA_ICRS_m'] = membs_cents_all[3][i]
-        df_UCC.at[idx, 'DE_ICRS_m'] = membs_cents_all[4][i]
-        df_UCC.at[idx, 'plx_m'] = membs_cents_all[5][i]
-        df_UCC.at[idx, 'pmRA_m'] = membs_cents_all[6][i]
-        df_UCC.at[idx, 'pmDE_m'] = membs_cents_all[7][i]
-        df_UCC.at[idx, 'Rv_m'] = membs_cents_all[8][i]
-        df_UCC.at[idx, 'N_Rv'] = membs_cents_all[9][i]
-        df_UCC.at[idx, 'N_ex_cls'] = N_ex_cls_all[i]
+# State of each worker process, set by 'init_worker'
+_worker_state = {}
 
-    df_UCC.to_csv(UCC_cat, na_rep='nan', index=False,
-                  quoting=csv.QUOTE_NONNUMERIC)
+
+def init_worker(journal_file, *state_args):
+    """
+    Initialize the shared data once per worker process, and open the
+    journal of this worker
+    """
+    _worker_state.update(cluster_state(*state_args))
+    _worker_state['f_journal'] = open(
+        journal_file.replace('.jsonl', f'_{os.getpid()}.jsonl'), 'a')
+
+
+def process_chunk(chunk):
+    """
+    Process a chunk of clusters in a worker process. The result of each
+    cluster is stored in the worker's journal as soon as it is obtained.
+    Returns the id of the worker and its frames cache hits and misses so far
+    """
+    for index, cl in chunk:
+        cl_result = process_cluster(index, cl, _worker_state)
+        write_journal(_worker_state['f_journal'], cl['UCC_ID'], cl_result)
+
+    frames_cache = _worker_state['frames_cache']
+    if frames_cache is None:
+        return os.getpid(), (0, 0)
+    return os.getpid(), (frames_cache.hits, frames_cache.misses)
+
+
+def chunk_clusters(clusters, N_chunks, dec_zone=5):
+    """
+    Split the (index, cluster) list into 'N_chunks' chunks of neighbouring
+    clusters. Clusters are sorted by Dec zones of 'dec_zone' degrees and by
+    RA inside each zone, so that clusters in the same chunk tend to require
+    the same Gaia frames
+    """
+    ra = np.array([cl['RA_ICRS'] for _, cl in clusters])
+    dec = np.array([cl['DE_ICRS'] for _, cl in clusters])
+    idx_sort = np.lexsort((ra, np.floor(dec / dec_zone)))
+    chunks = np.array_split(idx_sort, max(min(N_chunks, len(clusters)), 1))
+    return [[clusters[i] for i in chunk] for chunk in chunks if len(chunk)]
+
+
+def process_cluster(index, cl, state):
+    """
+    Process a single cluster with fastMP and store its datafile. Returns the
+    dictionary of values to update in the UCC for this cluster
+
+    state: data shared by all the clusters, see 'cluster_state'
+    """
+    fastMP, G3Q = state['fastMP'], state['G3Q']
+    out_path = state['out_path']
+
+    print(f"*** {index} Processing {cl['ID']} with fastMP...")
+    print(cl['GLON'], cl['GLAT'], cl['pmRA'], cl['pmDE'], cl['plx'])
+
+    # Generate frame
+    box_s, plx_min = get_frame(cl)
+
+    fname0 = cl['fnames'].split(';')[0]
+    # These clusters are extended require a larger frame
+    if fname0.startswith('ubc'):
+        box_s *= 3
+
+    # Get close clusters coords
+    centers_ex = get_close_cls(
+        cl['GLON'], cl['GLAT'], box_s, index, cl['dups_fnames'],
+        state['cls_data'])
+
+    # Request data
+    data = G3Q.run(
+        state['frames_path'], state['frames_data'], cl['RA_ICRS'],
+        cl['DE_ICRS'], box_s, plx_min, state['max_mag'],
+        frames_cache=state['frames_cache'], float32=state['float32'])
+    # Store full file
+    # # data.to_csv(out_path + fname0 + "_full.csv", index=False)
+    # data.to_parquet(out_path + fname0 + "_full.parquet", index=False)
+    # Read from file
+    # data = pd.read_csv(out_path + fname0 + "_full.csv")
+    # data.to_parquet(out_path + fname0 + "_full.parquet", index=False)
+    # data = pd.read_parquet(out_path + fname0 + "_full.parquet")
+    # data.to_csv(out_path + fname0 + "_full.csv", index=False)
+
+    # Extract center coordinates
+    xy_c, vpd_c, plx_c = (cl['GLON'], cl['GLAT']), None, None
+    if not np.isnan(cl['pmRA']):
+        vpd_c = (cl['pmRA'], cl['pmDE'])
+    if not np.isnan(cl['plx']):
+        plx_c = cl['plx']
+
+    fix_N_clust = False
+    fixed_centers = False
+    if vpd_c is None and plx_c is None:
+        fixed_centers = True
+
+    # Generate input data array for fastMP
+    X = np.array([
+        data['GLON'].values, data['GLAT'].values, data['pmRA'].values,
+        data['pmDE'].values, data['Plx'].values, data['e_pmRA'].values,
+        data['e_pmDE'].values, data['e_Plx'].values])
+
+    # Process with fastMP. If the center of the members does not match the
+    # catalogued one, fastMP is re-run once with fixed centers
+    N_refit = 0
+    while True:
+        print("Fixed centers?:", fixed_centers)
+        probs_all, N_survived = fastMP(
+            xy_c=xy_c, vpd_c=vpd_c, plx_c=plx_c, centers_ex=centers_ex,
+            fixed_centers=fixed_centers, fix_N_clust=fix_N_clust).fit(X)
+
+        msk_membs = membs_mask(probs_all)
+        bad_center = check_centers(
+            *X[:5, :], xy_c, vpd_c, plx_c, msk_membs)
+
+        if bad_center == '000' or fixed_centers is True:
+            break
+        else:
+            # print("Re-run with fixed_centers = True")
+            fixed_centers = True
+            N_refit += 1
+
+    # 'bad_center' is the result for the last fit
+    print("Nsurv={}, (P>0.5)={}, cents={}, refits={}".format(
+          N_survived, (probs_all > 0.5).sum(), bad_center, N_refit))
+
+    df_comb, df_membs, df_field, r_50, xy_c, vpd_c, plx_c =\
+        split_membs_field(data, probs_all, msk_membs)
+
+    rng = cluster_rng(state['seed'], cl['UCC_ID'])
+    C1, C2, C3 = get_classif(df_membs, df_field, rng, state['N_threads'])
+
+    N_50, lon, lat, ra, dec, plx, pmRA, pmDE, RV, N_Rv = extract_cl_data(
+        df_membs)
+
+    # Write member stars for cluster and some field
+    save_cl_datafile(cl, df_comb, out_path)
+
+    print(f"*** Cluster {cl['ID']} processed with fastMP\n")
+
+    return {
+        'r_50': r_50, 'N_fixed': fix_N_clust, 'N_membs': int(N_survived),
+        'fixed_cent': fixed_centers, 'cent_flags': bad_center, 'C1': C1,
+        'C2': C2, 'C3': C3, 'N_50': N_50, 'GLON_m': lon, 'GLAT_m': lat,
+        'RA_ICRS_m': ra, 'DE_ICRS_m': dec, 'plx_m': plx, 'pmRA_m': pmRA,
+        'pmDE_m': pmDE, 'Rv_m': RV, 'N_Rv': N_Rv,
+        'N_ex_cls': len(centers_ex), 'N_refit': N_refit}
 
 
 def read_input(frames_ranges, UCC_cat, GCs_cat):
@@ -184,37 +409,7 @@ def get_frame(cl):
     else:
         c_plx = None
 
-    if c_plx is None:
-        box_s_eq = .5
-    else:
-        # if c_plx > 3:
-        #     box_s_eq = min(50, 20 * np.log(.5*c_plx))
-        if c_plx > 10:
-            box_s_eq = 25
-        elif c_plx > 8:
-            box_s_eq = 20
-        elif c_plx > 6:
-            box_s_eq = 15
-        elif c_plx > 5:
-            box_s_eq = 10
-        elif c_plx > 4:
-            box_s_eq = 7.5
-        elif c_plx > 2:
-            box_s_eq = 5
-        elif c_plx > 1.5:
-            box_s_eq = 3
-        elif c_plx > 1:
-            box_s_eq = 2
-        elif c_plx > .75:
-            box_s_eq = 1.5
-        elif c_plx > .5:
-            box_s_eq = 1
-        elif c_plx > .25:
-            box_s_eq = .75
-        elif c_plx > .1:
-            box_s_eq = .5
-        else:
-            box_s_eq = .25  # 15 arcmin
+    box_s_eq = box_size(cl['plx'])
 
     if 'Ryu' in cl['ID']:
         box_s_eq = 10 / 60
@@ -237,100 +432,124 @@ def get_frame(cl):
     return box_s_eq, plx_min
 
 
-def get_close_cls(x, y, tree, box_s, idx, df_UCC, dups_fnames, df_gcs):
+def box_size(plx):
+    """
+    Size (in degrees) of the frame for the given parallax. Accepts a single
+    value or an array of parallaxes
+    """
+    plx = np.asarray(plx, dtype=float)
+    # if c_plx > 3:
+    #     box_s_eq = min(50, 20 * np.log(.5*c_plx))
+    box_s_eq = np.select(
+        (np.isnan(plx), plx > 10, plx > 8, plx > 6, plx > 5, plx > 4, plx > 2,
+         plx > 1.5, plx > 1, plx > .75, plx > .5, plx > .25, plx > .1),
+        (.5, 25, 20, 15, 10, 7.5, 5, 3, 2, 1.5, 1, .75, .5),
+        .25)  # 15 arcmin
+    return box_s_eq[()]
+
+
+def close_cls_data(df_UCC, df_gcs):
+    """
+    Arrays used by 'get_close_cls', generated once for all the clusters
+    """
+    x, y = df_UCC['GLON'].values, df_UCC['GLAT'].values
+    pmRA, pmDE = df_UCC['pmRA'].values, df_UCC['pmDE'].values
+    plx = df_UCC['plx'].values
+    gcs_x, gcs_y = df_gcs['GLON'].values, df_gcs['GLAT'].values
+
+    # Centers passed to fastMP for each cluster and GC
+    centers = []
+    for i in range(len(x)):
+        ex_cl_dict = {'xy': [x[i], y[i]]}
+        if not np.isnan(pmRA[i]):
+            ex_cl_dict['pms'] = [pmRA[i], pmDE[i]]
+        if not np.isnan(plx[i]):
+            ex_cl_dict['plx'] = [plx[i]]
+        centers.append(ex_cl_dict)
+    gcs_pmRA, gcs_pmDE = df_gcs['pmRA'].values, df_gcs['pmDE'].values
+    gcs_plx = df_gcs['plx'].values
+    gcs_centers = [
+        {'xy': [gcs_x[i], gcs_y[i]], 'pms': [gcs_pmRA[i], gcs_pmDE[i]],
+         'plx': [gcs_plx[i]]} for i in range(len(gcs_x))]
+
+    return {
+        'tree': spatial.cKDTree(np.array([x, y]).T), 'x': x, 'y': y,
+        'fnames': [set(_.split(';')) for _ in df_UCC['fnames']],
+        'nan_pm_plx': np.isnan(pmRA) | np.isnan(plx), 'centers': centers,
+        'gcs_tree': spatial.cKDTree(np.array([gcs_x, gcs_y]).T),
+        'gcs_x': gcs_x, 'gcs_y': gcs_y, 'gcs_centers': gcs_centers}
+
+
+def get_close_cls(x, y, box_s, idx, dups_fnames, cls_data):
     """
     Get data on the closest clusters to the one being processed
 
     idx: Index to the cluster in the full list
+    cls_data: arrays generated by 'close_cls_data'
     """
 
     # Radius that contains the entire frame
     rad = np.sqrt(2 * (box_s/2)**2)
     # Indexes to the closest clusters in XY
-    ex_cls_idx = tree.query_ball_point([x, y], rad)
+    ex_cls_idx = np.array(
+        cls_data['tree'].query_ball_point([x, y], rad), dtype=int)
     # Remove self cluster
-    del ex_cls_idx[ex_cls_idx.index(idx)]
-
-    duplicate_cls = []
+    ex_cls_idx = ex_cls_idx[ex_cls_idx != idx]
+
+    # If the cluster does not contain PM or Plx information, check its
+    # distance in (lon, lat) with the main cluster. If the distance locates
+    # this cluster within 0.5 of the frame's radius (i.e.: within the
+    # expected region of the main cluster), don't store it for removal.
+    #
+    # This prevents clusters with no PM|Plx data from disrupting
+    # neighbouring clusters (e.g.: NGC 2516 disrupted by FSR 1479) and
+    # at the same time removes more distant clusters that disrupt the
+    # number of members estimation process in fastMP
+    ex_x, ex_y = cls_data['x'][ex_cls_idx], cls_data['y'][ex_cls_idx]
+    xy_dist = np.sqrt((x - ex_x)**2 + (y - ex_y)**2)
+    msk_keep = ~(cls_data['nan_pm_plx'][ex_cls_idx] & (xy_dist < 0.5 * rad))
+
+    # Check if the close clusters are identified as probable duplicates
+    # of this cluster (through any of their fnames). If they are, do not add
+    # them to the list of extra clusters in the frame
     if str(dups_fnames) != 'nan':
-        duplicate_cls = dups_fnames.split(';')
-
-    centers_ex = []
-    for i in ex_cls_idx:
-
-        # Check if this close cluster is identified as a probable duplicate
-        # of this cluster. If it is, do not add it to the list of extra
-        # clusters in the frame
-        skip_cl = False
-        if duplicate_cls:
-            for dup_fname_i in df_UCC['fnames'][i].split(';'):
-                if dup_fname_i in duplicate_cls:
-                    # print("skip", df_UCC['fnames'][i])
-                    skip_cl = True
-                    break
-            if skip_cl:
-                continue
-
-        # If the cluster does not contain PM or Plx information, check its
-        # distance in (lon, lat) with the main cluster. If the distance locates
-        # this cluster within 0.5 of the frame's radius (i.e.: within the
-        # expected region of the main cluster), don't store it for removal.
-        #
-        # This prevents clusters with no PM|Plx data from disrupting
-        # neighbouring clusters (e.g.: NGC 2516 disrupted by FSR 1479) and
-        # at the same time removes more distant clusters that disrupt the
-        # number of members estimation process in fastMP
-        if np.isnan(df_UCC['pmRA'][i]) or np.isnan(df_UCC['plx'][i]):
-            xy_dist = np.sqrt(
-                (x-df_UCC['GLON'][i])**2+(y-df_UCC['GLAT'][i])**2)
-            if xy_dist < 0.5 * rad:
-                # print(df_UCC['ID'][i], df_UCC['GLON'][i], df_UCC['GLAT'][i], xy_dist)
-                continue
-
-        # if np.isnan(df_UCC['pmRA'][i]) or np.isnan(df_UCC['plx'][i]):
-        #     continue
-
-        ex_cl_dict = {
-            'xy': [df_UCC['GLON'][i], df_UCC['GLAT'][i]]}
-        if not np.isnan(df_UCC['pmRA'][i]):
-            ex_cl_dict['pms'] = [df_UCC['pmRA'][i], df_UCC['pmDE'][i]]
-        if not np.isnan(df_UCC['plx'][i]):
-            ex_cl_dict['plx'] = [df_UCC['plx'][i]]
-
-        # print(df_UCC['ID'][i], ex_cl_dict)
-        centers_ex.append(ex_cl_dict)
-
-    # Add closest GC
-    # print()
-    x, y = df_UCC['GLON'][idx], df_UCC['GLAT'][idx]
-    gc_d = np.sqrt((x-df_gcs['GLON'])**2 + (y-df_gcs['GLAT'])**2).values
-    for gc_i in range(len(df_gcs)):
-        if gc_d[gc_i] < rad:
-            ex_cl_dict = {'xy': [df_gcs['GLON'][gc_i], df_gcs['GLAT'][gc_i]],
-                          'pms': [df_gcs['pmRA'][gc_i], df_gcs['pmDE'][gc_i]],
-                          'plx': [df_gcs['plx'][gc_i]]}
-            # print(df_gcs['Name'][gc_i], ex_cl_dict)
-            centers_ex.append(ex_cl_dict)
+        duplicate_cls = set(dups_fnames.split(';'))
+        msk_keep &= np.array([
+            duplicate_cls.isdisjoint(cls_data['fnames'][i])
+            for i in ex_cls_idx], dtype=bool)
+
+    # Copies of the stored centers are returned, so that they are not
+    # modified by fastMP
+    centers = cls_data['centers']
+    centers_ex = [
+        {k: list(v) for k, v in centers[i].items()}
+        for i in ex_cls_idx[msk_keep]]
+
+    # Add closest GCs
+    x, y = cls_data['x'][idx], cls_data['y'][idx]
+    gcs_idx = cls_data['gcs_tree'].query_ball_point(
+        [x, y], rad, return_sorted=True)
+    if gcs_idx:
+        gcs_idx = np.array(gcs_idx)
+        gc_d = np.sqrt(
+            (x - cls_data['gcs_x'][gcs_idx])**2
+            + (y - cls_data['gcs_y'][gcs_idx])**2)
+        gcs_centers = cls_data['gcs_centers']
+        centers_ex += [
+            {k: list(v) for k, v in gcs_centers[i].items()}
+            for i in gcs_idx[gc_d < rad]]
 
     return centers_ex
 
 
-def check_centers(
-    lon, lat, pmRA, pmDE, plx, xy_c, vpd_c, plx_c, probs_all, N_membs_min=25
-):
+def check_centers(lon, lat, pmRA, pmDE, plx, xy_c, vpd_c, plx_c, msk):
     """
+    msk: high-quality members, see 'membs_mask'
     """
-    # Select high-quality members
-    msk = probs_all > 0.5
-    if msk.sum() < N_membs_min:
-        idx = np.argsort(probs_all)[::-1][:N_membs_min]
-        msk = np.full(len(probs_all), False)
-        msk[idx] = True
-
     # Centers of selected members
-    xy_c_f = np.nanmedian([lon[msk], lat[msk]], 1)
-    vpd_c_f = np.nanmedian([pmRA[msk], pmDE[msk]], 1)
-    plx_c_f = np.nanmedian(plx[msk])
+    lon_c_f, lat_c_f, pmRA_c_f, pmDE_c_f, plx_c_f = np.nanmedian(
+        [lon[msk], lat[msk], pmRA[msk], pmDE[msk], plx[msk]], 1)
+    xy_c_f, vpd_c_f = (lon_c_f, lat_c_f), (pmRA_c_f, pmDE_c_f)
 
     bad_center_xy, bad_center_pm, bad_center_plx = '0', '0', '0'
 
@@ -388,22 +607,38 @@ def check_centers(
     return bad_center
 
 
+def membs_mask(probs, prob_cut=0.5, N_membs_min=25):
+    """
+    Select the stars with P>prob_cut as members or, if there are less than
+    'N_membs_min' of them, the 'N_membs_min' stars with the largest
+    probabilities. Stars tied with the smallest selected probability are
+    taken in the order they appear in 'probs'
+    """
+    probs = np.asarray(probs)
+    msk = probs > prob_cut
+    if msk.sum() < N_membs_min:
+        N_membs_min = min(N_membs_min, len(probs))
+        if N_membs_min == 0:
+            return msk
+        # Smallest probability among the selected stars
+        kth = len(probs) - N_membs_min
+        p_min = np.partition(probs, kth)[kth]
+        msk = probs > p_min
+        idx_tie = np.flatnonzero(probs == p_min)
+        msk[idx_tie[:N_membs_min - msk.sum()]] = True
+    return msk
+
+
 def split_membs_field(
-    data, probs_all, prob_cut=0.5, N_membs_min=25, perc_cut=95, N_perc=2
+    data, probs_all, msk_membs, prob_cut=0.5, N_membs_min=25, perc_cut=95,
+    N_perc=2
 ):
     """
+    msk_membs: most likely members in 'data', see 'membs_mask'
     """
     # This first filter removes stars beyond 2 times the 95th percentile
     # of the most likely members
 
-    # Select most likely members
-    msk_membs = probs_all >= prob_cut
-    if msk_membs.sum() < N_membs_min:
-        # Select the 'N_membs_min' stars with the largest probabilities
-        idx = np.argsort(probs_all)[::-1][:N_membs_min]
-        msk_membs = np.full(len(probs_all), False)
-        msk_membs[idx] = True
-
     # Find xy filter
     xy = np.array([data['GLON'].values, data['GLAT'].values]).T
     xy_c = np.nanmedian(xy[msk_membs], 0)
@@ -426,15 +661,12 @@ def split_membs_field(
     data['probs'] = np.round(probs_all, 5)
     # This dataframe contains both members and a selected portion of
     # field stars
-    df_comb = data.loc[msk]
-    df_comb.reset_index(drop=True, inplace=True)
-
-    # Split into members and field, now using the filtered dataframe
-    msk_membs = df_comb['probs'] > prob_cut
-    if msk_membs.sum() < N_membs_min:
-        idx = np.argsort(df_comb['probs'].values)[::-1][:N_membs_min]
-        msk_membs = np.full(len(df_comb['probs']), False)
-        msk_membs[idx] = True
+    df_comb = data.loc[msk].reset_index(drop=True)
+
+    # Split into members and field, now using the filtered dataframe. The
+    # mask is stored in the datafile
+    msk_membs = membs_mask(df_comb['probs'], prob_cut, N_membs_min)
+    df_comb['membs'] = msk_membs
     df_membs, df_field = df_comb[msk_membs], df_comb[~msk_membs]
 
     # XY center and distances
@@ -456,11 +688,14 @@ def split_membs_field(
     return df_comb, df_membs, df_field, r_50, xy_c, vpd_c, plx_c
 
 
-def get_classif(df_membs, df_field):
+def get_classif(df_membs, df_field, rng=None, N_threads=-1):
     """
+    rng: seed or numpy Generator used by the classification
+    N_threads: number of threads used by the KD-tree queries in 'dens_ratio'
     """
-    C1 = lkl_phot(df_membs, df_field)
-    C2 = dens_ratio(df_membs, df_field)
+    rng = np.random.default_rng(rng)
+    C1 = lkl_phot(df_membs, df_field, rng)
+    C2 = dens_ratio(df_membs, df_field, rng, N_threads=N_threads)
 
     def ABCD_classif(CC):
         """Obtain 'ABCD' classification"""
@@ -478,8 +713,9 @@ def get_classif(df_membs, df_field):
     return round(C1, 2), round(C2, 2), C3
 
 
-def lkl_phot(df_membs, df_field):
+def lkl_phot(df_membs, df_field, rng=None):
     """
+    rng: seed or numpy Generator used to sample the field regions
     """
     x_cl, y_cl = df_membs['Gmag'].values, df_membs['BP-RP'].values
     msk_nan = np.isnan(x_cl) | np.isnan(y_cl)
@@ -504,46 +740,45 @@ def lkl_phot(df_membs, df_field):
     else:
         runs = 100
 
-    idx = np.arange(0, N_field)
-    prep_clust_cl = prep_data(x_cl, y_cl)
-    lkl_cl_max = tremmel([x_cl, y_cl], prep_clust_cl)
+    # Sample two field regions per run, all runs at once
+    rng = np.random.default_rng(rng)
+    msk = np.array([
+        rng.choice(N_field, N_membs, replace=False) for _ in range(2 * runs)])
+    x_f1, y_f1 = x_fl[msk[:runs]], y_fl[msk[:runs]]
+    x_f2, y_f2 = x_fl[msk[runs:]], y_fl[msk[runs:]]
 
-    pv_cl, pv_fr = [], []
-    for run_num in range(runs):
+    # Bin edges defined by the cluster, and by the first field region of
+    # each run
+    edges_cl = bin_edges_f(x_cl[None, :], y_cl[None, :])
+    edges_f1 = bin_edges_f(x_f1, y_f1)
 
-        # Sample two field regions
-        msk1 = np.random.choice(idx, N_membs, replace=False)
-        field1 = [x_fl[msk1], y_fl[msk1]]
-        msk2 = np.random.choice(idx, N_membs, replace=False)
-        field2 = [x_fl[msk2], y_fl[msk2]]
+    histo_cl = histo_runs(x_cl[None, :], y_cl[None, :], edges_cl)
+    histo_f1 = histo_runs(x_f1, y_f1, edges_f1)
+    lkl_cl_max = tremmel(histo_cl, histo_cl, 1, N_membs)
+    lkl_fl_max = tremmel(histo_f1, histo_f1, runs, N_membs)
 
-        prep_clust_f1 = prep_data(field1[0], field1[1])
-        lkl_fl_max = tremmel(field1, prep_clust_f1)
+    # Same cluster bins for all the runs
+    edges_cl = [np.repeat(_, runs) for _ in edges_cl]
+    histo_f1_cl = histo_runs(x_f1, y_f1, edges_cl)
+    histo_cl = (np.tile(histo_cl[0], runs), histo_f1_cl[1])
+    histo_f2_f1 = histo_runs(x_f2, y_f2, edges_f1)
 
-        lkl_cl = tremmel(field1, prep_clust_cl) - lkl_cl_max
-        lkl_fl = tremmel(field2, prep_clust_f1) - lkl_fl_max
-        pv_cl.append(lkl_cl)
-        pv_fr.append(lkl_fl)
+    pv_cl = tremmel(histo_cl, histo_f1_cl, runs, N_membs) - lkl_cl_max
+    pv_fr = tremmel(histo_f1, histo_f2_f1, runs, N_membs) - lkl_fl_max
 
     C1 = KDEoverlap(pv_cl, pv_fr)
     return C1
 
 
-def KDEoverlap(p_vals_cl, p_vals_fl):
+def KDEoverlap(p_vals_cl, p_vals_fl, N_grid=1000):
     """
-    Calculate overlap between the two KDEs
+    Calculate overlap between the two KDEs, integrated over a fixed grid
     """
-    def y_pts(pt):
-        y_pt = min(kcl(pt), kfr(pt))
-        return y_pt
-
     kcl, kfr = gaussian_kde(p_vals_cl), gaussian_kde(p_vals_fl)
 
     all_pvals = np.concatenate([p_vals_cl, p_vals_fl])
-    pmin, pmax = all_pvals.min(), all_pvals.max()
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        overlap = quad(y_pts, pmin, pmax)[0]
+    pts = np.linspace(all_pvals.min(), all_pvals.max(), N_grid)
+    overlap = trapezoid(np.minimum(kcl(pts), kfr(pts)), pts)
 
     # Probability value for the cluster.
     prob_cl = 1. - overlap
@@ -551,119 +786,137 @@ def KDEoverlap(p_vals_cl, p_vals_fl):
     return prob_cl
 
 
-def prep_data(mag, col):
-    """
-    """
-
-    # Obtain bin edges for each dimension, defining a grid.
-    bin_edges = bin_edges_f(mag, col)
-
-    # Histogram for observed cluster.
-    cl_histo = np.histogramdd([mag, col], bins=bin_edges)[0]
-
-    # Flatten N-dimensional histograms.
-    cl_histo_f = np.array(cl_histo).ravel()
-
-    # Index of bins where stars were observed
-    cl_z_idx = (cl_histo_f != 0)
-
-    # Remove all bins where n_i=0 (no observed stars)
-    cl_histo_f_z = cl_histo_f[cl_z_idx]
-
-    return [bin_edges, cl_histo_f_z, cl_z_idx]
-
-
 def bin_edges_f(mag, col, min_bins=2, max_bins=50):
     """
-    Obtain bin edges for each photometric dimension using the cluster region
-    diagram. The 'bin_edges' list will contain all magnitudes first, and then
-    all colors (in the same order in which they are read).
+    Obtain the (uniform) bin edges for each photometric dimension using the
+    cluster region diagram, for each row of 'mag, col'. The edges are given
+    as the (first edge, last edge, number of bins) arrays for the magnitude,
+    and then for the color.
     """
     bin_edges = []
-    b_num = int(round(max(2, (max(mag) - min(mag)) / 1.)))
-    bin_edges.append(np.histogram(mag, bins=b_num)[1])
-    b_num = int(round(max(2, (max(col) - min(col)) / .5)))
-    bin_edges.append(np.histogram(col, bins=b_num)[1])
-
-    # Impose a minimum of 'min_bins' cells per dimension. The number of bins
-    # is the number of edges minus 1.
-    for i, be in enumerate(bin_edges):
-        N_bins = len(be) - 1
-        if N_bins < min_bins:
-            bin_edges[i] = np.linspace(be[0], be[-1], min_bins + 1)
-
-    # Impose a maximum of 'max_bins' cells per dimension.
-    for i, be in enumerate(bin_edges):
-        N_bins = len(be) - 1
-        if N_bins > max_bins:
-            bin_edges[i] = np.linspace(be[0], be[-1], max_bins)
+    for data, width in ((mag, 1.), (col, .5)):
+        e0, e1 = data.min(1), data.max(1)
+        b_num = np.round(np.maximum(2, (e1 - e0) / width)).astype(int)
+        # Same range as used by 'np.histogram'
+        msk = e0 == e1
+        e0, e1 = np.where(msk, e0 - .5, e0), np.where(msk, e1 + .5, e1)
+        # Impose a minimum of 'min_bins' cells per dimension.
+        b_num = np.maximum(b_num, min_bins)
+        # Impose a maximum of 'max_bins' cells per dimension (re-binned to
+        # 'max_bins' edges)
+        b_num = np.where(b_num > max_bins, max_bins - 1, b_num)
+        bin_edges += [e0, e1, b_num]
 
     return bin_edges
 
 
-def tremmel(field, prep_clust):
+def histo_bins(data, e0, e1, b_num):
     """
-    Poisson likelihood ratio as defined in Tremmel et al (2013), Eq 10 with
-    v_{i,j}=1.
+    Index of the bin of each value, with the same limits as the
+    'np.linspace(e0, e1, b_num + 1)' edges used by 'np.histogramdd'. Values
+    out of the range are assigned a -1 index
+    """
+    e0, e1, b_num = e0[:, None], e1[:, None], b_num[:, None]
+    step = (e1 - e0) / b_num
+    idx = np.clip(np.floor((data - e0) / step), 0, b_num - 1).astype(int)
+    # Correct for the rounding in the division, the edges are computed as in
+    # 'np.linspace'
+    idx -= data < idx * step + e0
+    e_up = np.where(idx + 1 == b_num, e1, (idx + 1) * step + e0)
+    idx += (data >= e_up) & (idx + 1 < b_num)
+    idx[(data < e0) | (data > e1)] = -1
+    return idx
+
+
+def histo_runs(mag, col, bin_edges):
     """
+    Flattened 2D histograms for each row of 'mag, col', each one with its own
+    bin edges. Returns the histograms concatenated, and the row each bin
+    belongs to
+    """
+    me0, me1, m_num, ce0, ce1, c_num = bin_edges
+    m_idx = histo_bins(mag, me0, me1, m_num)
+    c_idx = histo_bins(col, ce0, ce1, c_num)
 
-    # Observed cluster's data.
-    bin_edges, cl_histo_f_z, cl_z_idx = prep_clust
+    N_bins = m_num * c_num
+    offset = np.cumsum(N_bins) - N_bins
+    flat_idx = offset[:, None] + m_idx * c_num[:, None] + c_idx
+    msk = (m_idx >= 0) & (c_idx >= 0)
+    histo = np.bincount(flat_idx[msk], minlength=N_bins.sum())
+    rows = np.repeat(np.arange(len(N_bins)), N_bins)
 
-    # Histogram of the synthetic cluster, using the bin edges calculated
-    # with the observed cluster.
-    syn_histo = np.histogramdd(field, bins=bin_edges)[0]
+    return histo, rows
 
-    # TODO: testing this implementation of histodd. Related:
-    # #258, #515
-    # syn_histo = histogramdd(field, bins=bin_edges)
 
-    # Flatten N-dimensional histogram.
-    syn_histo_f = syn_histo.ravel()
+def tremmel(histo_obs, histo_syn, runs, N_syn):
+    """
+    Poisson likelihood ratio as defined in Tremmel et al (2013), Eq 10 with
+    v_{i,j}=1, for each run.
+
+    histo_obs, histo_syn: '(histogram, rows)' as returned by 'histo_runs',
+    for the observed and the synthetic (field) data, using the same bins
+    N_syn: number of stars in each synthetic histogram
+    """
+    cl_histo_f, rows = histo_obs
+    syn_histo_f = histo_syn[0]
+
     # Remove all bins where n_i = 0 (no observed stars).
-    syn_histo_f_z = syn_histo_f[cl_z_idx]
+    cl_z_idx = cl_histo_f != 0
+    cl_histo_f_z, syn_histo_f_z = cl_histo_f[cl_z_idx], syn_histo_f[cl_z_idx]
 
-    SumLogGamma = np.sum(
-        loggamma(cl_histo_f_z + syn_histo_f_z + .5)
-        - loggamma(syn_histo_f_z + .5))
+    SumLogGamma = np.bincount(
+        rows[cl_z_idx], weights=loggamma(cl_histo_f_z + syn_histo_f_z + .5)
+        - loggamma(syn_histo_f_z + .5), minlength=runs)
 
     # M = field.shape[0]
     # ln(2) ~ 0.693
-    tremmel_lkl = SumLogGamma - 0.693 * len(field[0])
+    tremmel_lkl = SumLogGamma - 0.693 * N_syn
 
     return tremmel_lkl
 
 
-def dens_ratio(df_membs, df_field, N_neigh=10, N_max=1000, norm_v=5):
+def dens_ratio(
+    df_membs, df_field, rng=None, N_neigh=10, N_max=1000, norm_v=5,
+    N_threads=-1
+):
     """
+    rng: seed or numpy Generator used to subsample the field stars
+    N_threads: number of threads used by the KD-tree queries (-1 for all
+    the cores)
     """
     # Obtain the median distance to the 'N_neigh' closest neighbours in 5D
     # for each member
     arr = df_membs[['GLON', 'GLAT', 'pmRA', 'pmDE', 'Plx']].values
     # arr = data_norm[:N_stars, :]
-    tree = spatial.KDTree(arr)
-    dists = tree.query(arr, min(arr.shape[0], N_neigh))[0]
+    tree = spatial.cKDTree(arr)
+    dists = tree.query(
+        arr, min(arr.shape[0], N_neigh), workers=N_threads)[0]
     med_d_membs = np.median(dists[1:, :])
 
     # Radius that contains 95th of the members for the coordinates
-    xy = np.array([df_membs['GLON'].values, df_membs['GLAT'].values]).T
-    xy_c = np.nanmedian(xy, 0)
-    xy_dists = spatial.distance.cdist(xy, np.array([xy_c])).T[0]
+    x, y = df_membs['GLON'].values, df_membs['GLAT'].values
+    xy_c = np.nanmedian([x, y], 1)
+    xy_dists = np.sqrt((x - xy_c[0])**2 + (y - xy_c[1])**2)
     rad = np.percentile(xy_dists, 95)
 
     # Select field stars within the above radius from the member's center
-    xy = np.array([df_field['GLON'].values, df_field['GLAT'].values]).T
-    xy_dists = spatial.distance.cdist(xy, np.array([xy_c])).T[0]
-    msk = np.arange(0, len(xy_dists))[xy_dists < rad]
+    x, y = df_field['GLON'].values, df_field['GLAT'].values
+    xy_dists = np.sqrt((x - xy_c[0])**2 + (y - xy_c[1])**2)
+    msk = np.flatnonzero(xy_dists < rad)
     if len(msk) > N_max:
+        # Random subsample, with the same number of stars that the
+        # 'msk[::step]' stride selected before
         step = max(1, int(len(msk) / N_max))
-        msk = msk[::step]
+        N_sample = -(-len(msk) // step)
+        rng = np.random.default_rng(rng)
+        msk = np.sort(rng.choice(msk, N_sample, replace=False))
 
     arr = df_field[['GLON', 'GLAT', 'pmRA', 'pmDE', 'Plx']].values
     if len(df_field) > 10:
         arr = arr[msk, :]
-    tree = spatial.KDTree(arr)
-    dists = tree.query(arr, min(arr.shape[0], N_neigh))[0]
+    tree = spatial.cKDTree(arr)
+    dists = tree.query(
+        arr, min(arr.shape[0], N_neigh), workers=N_threads)[0]
     med_d_field = np.median(dists[1:, :])
 
     d_ratio = min(med_d_field/med_d_membs, norm_v) / norm_v
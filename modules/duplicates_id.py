@@ -1,49 +1,69 @@
 
+import warnings
 import numpy as np
-from scipy.spatial.distance import cdist
+from scipy import spatial
 
 
-def run(df, N_dups=20, prob_cut=0.25):
+def run(df, N_dups=20, prob_cut=0.25, N_chunk=1000):
     """
     Assign a 'duplicate probability' for each cluster in 'df' compared to the
     rest of the listed clusters
+
+    N_chunk: number of clusters processed at once
     """
     x, y = df['GLON_m'], df['GLAT_m']
     pmRA, pmDE, plx = df['pmRA_m'], df['pmDE_m'], df['plx_m']
 
-    x, y = df['GLON'], df['GLAT']
-    pmRA, pmDE, plx = df['pmRA'], df['pmDE'], df['plx']
+    x, y = df['GLON'].values, df['GLAT'].values
+    pmRA, pmDE, plx = df['pmRA'].values, df['pmDE'].values, df['plx'].values
+
+    # Store just the first fname
+    fnames0 = np.array([_.split(';')[0] for _ in df['fnames']])
 
-    coords = np.array([x, y]).T
-    # Find the distances to all clusters, for all clusters
-    dist = cdist(coords, coords)
-    # Change distance to itself from 0 to inf
-    msk = dist == 0.
-    dist[msk] = np.inf
+    # Spatial index over (GLON, GLAT), periodic in GLON
+    tree = coords_tree(x, y)
+    N_cls = len(x)
+    # The closest cluster is the cluster itself
+    N_query = min(N_dups + 1, N_cls)
 
     dups_fnames, dups_probs = [], []
-    for i, cl in enumerate(dist):
+    for i0 in range(0, N_cls, N_chunk):
+        i1 = min(i0 + N_chunk, N_cls)
         # Only look for duplicates among the closest 'N_dups' clusters
-        idx = np.argsort(cl)[:N_dups]
+        dist, idx_j = tree.query(tree.data[i0:i1], N_query)
+        dist, idx_j = dist.reshape(i1 - i0, -1), idx_j.reshape(i1 - i0, -1)
+        # Remove the cluster itself (and any cluster located at the exact
+        # same coordinates)
+        msk_zero = dist == 0.
+        dist[msk_zero] = np.inf
+        idx_sort = np.argsort(dist, 1, kind='stable')[:, :N_dups]
+        idx_j = np.take_along_axis(idx_j, idx_sort, 1)
+        msk_zero = np.take_along_axis(msk_zero, idx_sort, 1)
+        idx_i = np.arange(i0, i1)[:, None]
+
+        probs = duplicate_probs(x, y, pmRA, pmDE, plx, idx_i, idx_j)
+
+        for k, probs_k in enumerate(probs):
+            msk = (probs_k >= prob_cut) & ~msk_zero[k]
+            if msk.any():
+                dups_fnames.append(";".join(fnames0[idx_j[k][msk]]))
+                dups_probs.append(";".join([str(_) for _ in probs_k[msk]]))
+            else:
+                dups_fnames.append('nan')
+                dups_probs.append('nan')
 
-        dups_fname, dups_prob = [], []
-        for j in idx:
-            dup_prob = duplicate_probs(x, y, pmRA, pmDE, plx, i, j)
-            if dup_prob >= prob_cut:
-                # Store just the first fname
-                dups_fname.append(df['fnames'][j].split(';')[0])
-                dups_prob.append(str(dup_prob))
-
-        if dups_fname:
-            dups_fname = ";".join(dups_fname)
-            dups_prob = ";".join(dups_prob)
-        else:
-            dups_fname, dups_prob = 'nan', 'nan'
+    return dups_fnames, dups_probs
 
-        dups_fnames.append(dups_fname)
-        dups_probs.append(dups_prob)
 
-    return dups_fnames, dups_probs
+def coords_tree(x, y):
+    """
+    KD-tree over the (GLON, GLAT) coordinates of the clusters. The GLON
+    dimension is periodic so that clusters at both sides of the 0/360 limit
+    are properly identified as neighbours
+    """
+    xy = np.array([np.asarray(x, dtype=float) % 360, y]).T
+    # A non-positive box size marks a non-periodic dimension
+    return spatial.cKDTree(xy, boxsize=[360, 0])
 
 
 def duplicate_probs(x, y, pmRA, pmDE, plx, i, j, Nmax=2):
@@ -51,60 +71,56 @@ def duplicate_probs(x, y, pmRA, pmDE, plx, i, j, Nmax=2):
     Identify a cluster as a duplicate following an arbitrary definition
     that depends on the parallax
 
+    The indexes 'i, j' can be integers or arrays of indexes (of broadcastable
+    shapes), in which case all the (i, j) pairs are processed at once and an
+    array of probabilities is returned
+
     Nmax: maximum number of times allowed for the two objects to be apart
     in any of the dimensions. If this happens for any of the dimensions,
     return a probability of zero
     """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    pmRA, pmDE = np.asarray(pmRA, dtype=float), np.asarray(pmDE, dtype=float)
+    plx = np.asarray(plx, dtype=float)
+    i, j = np.asarray(i), np.asarray(j)
 
     # Define reference parallax
-    if np.isnan(plx[i]) and np.isnan(plx[j]):
-        plx_ref = np.nan
-    elif np.isnan(plx[i]):
-        plx_ref = plx[j]
-    elif np.isnan(plx[j]):
-        plx_ref = plx[i]
-    else:
-        plx_ref = (plx[i] + plx[i]) * .5
+    plx_i, plx_j = plx[i], plx[j]
+    # If both values are present, the parallax of the 'i' cluster is used
+    plx_ref = np.where(np.isnan(plx_i), plx_j, plx_i)
 
     # Arbitrary 'duplicate regions' for different parallax brackets
-    if np.isnan(plx_ref):
-        rad, plx_r, pm_r = 2.5, np.nan, 0.2
-    elif plx_ref >= 4:
-        rad, plx_r, pm_r = 20, 0.5, 1
-    elif 3 <= plx_ref and plx_ref < 4:
-        rad, plx_r, pm_r = 15, 0.25, 0.75
-    elif 2 <= plx_ref and plx_ref < 3:
-        rad, plx_r, pm_r = 10, 0.2, 0.5
-    elif 1.5 <= plx_ref and plx_ref < 2:
-        rad, plx_r, pm_r = 7.5, 0.15, 0.35
-    elif 1 <= plx_ref and plx_ref < 1.5:
-        rad, plx_r, pm_r = 5, 0.1, 0.25
-    elif .5 <= plx_ref < 1:
-        rad, plx_r, pm_r = 2.5, 0.075, 0.2
-    elif plx_ref < .5:
-        rad, plx_r, pm_r = 2, 0.05, 0.15
-    elif plx_ref < .25:
-        rad, plx_r, pm_r = 1.5, 0.025, 0.1
-
-    # Angular distance in arcmin
-    d = np.sqrt((x[i]-x[j])**2 + (y[i]-y[j])**2) * 60
+    brackets = (
+        np.isnan(plx_ref), plx_ref >= 4, plx_ref >= 3, plx_ref >= 2,
+        plx_ref >= 1.5, plx_ref >= 1, plx_ref >= .5)
+    rad = np.select(brackets, (2.5, 20, 15, 10, 7.5, 5, 2.5), 2)
+    plx_r = np.select(
+        brackets, (np.nan, 0.5, 0.25, 0.2, 0.15, 0.1, 0.075), 0.05)
+    pm_r = np.select(brackets, (0.2, 1, 0.75, 0.5, 0.35, 0.25, 0.2), 0.15)
+
+    # Angular distance in arcmin, wrapping GLON around 0/360
+    x_d = abs(x[i] - x[j]) % 360
+    x_d = np.minimum(x_d, 360 - x_d)
+    d = np.sqrt(x_d**2 + (y[i]-y[j])**2) * 60
     # PMs distance
     pm_d = np.sqrt((pmRA[i]-pmRA[j])**2 + (pmDE[i]-pmDE[j])**2)
     # Parallax distance
-    plx_d = abs(plx[i] - plx[j])
+    plx_d = abs(plx_i - plx_j)
 
     # If *any* distance is *very* far away, return no duplicate disregarding
     # the rest with 0 probability
-    if d > Nmax * rad or pm_d > Nmax * pm_r or plx_d > Nmax * plx_r:
-        return 0
+    msk_far = (d > Nmax * rad) | (pm_d > Nmax * pm_r) | (plx_d > Nmax * plx_r)
 
     d_prob = lin_relation(d, rad)
     pms_prob = lin_relation(pm_d, pm_r)
     plx_prob = lin_relation(plx_d, plx_r)
-    # prob = round((d_prob+pms_prob+plx_prob)/3., 2)
-    prob = np.nanmean((d_prob, pms_prob, plx_prob))
+    with warnings.catch_warnings():
+        # All three probabilities can be nan
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        prob = np.nanmean([d_prob, pms_prob, plx_prob], 0)
+    prob = np.where(msk_far, 0., np.round(prob, 2))
 
-    return round(prob, 2)
+    return prob[()]
 
     # # # If the coordinates distance is larger than the defined radius,
     # # # mark as no duplicate disregarding PMs and Plx, but return the
@@ -146,9 +162,8 @@ def lin_relation(dist, d_max):
     # prob = (dist - h) / m
     # m, h = -d_max, d_max
     p = (dist - d_max) / -d_max
-    if p < 0:  # np.isnan(p) or
-        return 0
-    return p
+    # np.isnan(p) values are kept
+    return np.where(p < 0, 0., p)
 
 
 if __name__ == '__main__':
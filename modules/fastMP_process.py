@@ -1,34 +1,51 @@
 
-import numpy as np
+import csv
+import pandas as pd
 from . import call_fastMP
+from . import DBs_combine
+from . import rerun_plan
 from . import main_process_GDR3_query as G3Q
 
 
 def run(
-    fastMP, new_DB, frames_path, frames_ranges, UCC_cat, GCs_cat, out_path
+    fastMP, new_DB, frames_path, frames_ranges, UCC_cat, GCs_cat, out_path,
+    N_workers=1, resume=False, UCC_cat_old=None
 ):
     """
+    UCC_cat_old: previous version of the UCC catalogue. If given, only the
+    clusters that changed with respect to it are processed (see
+    'rerun_plan.run') and 'new_DB' is ignored
+    N_workers: number of processes used to process the clusters
+    resume: skip the clusters already processed by a previous (interrupted)
+    run, see 'call_fastMP.run'
     """
     # Read data
     frames_data, df_UCC, df_gcs = call_fastMP.read_input(
         frames_ranges, UCC_cat, GCs_cat)
-
-    if new_DB is None:
+    # Frames ranges shared by all the processed clusters
+    frames_data = G3Q.frames_index(frames_data)
+
+    if UCC_cat_old is not None:
+        # Only process the clusters affected by the changes in the catalogue
+        df_plan = rerun_plan.run(pd.read_csv(UCC_cat_old), df_UCC, df_gcs)
+        plan_file = UCC_cat.replace('.csv', '') + '_rerun.csv'
+        df_plan.to_csv(
+            plan_file, index=False, quoting=csv.QUOTE_NONNUMERIC)
+        N_reasons = df_plan['reasons'].str.split(';').explode().value_counts()
+        print(f"N={len(df_plan)} clusters to process ({plan_file})")
+        for reason, N in N_reasons.items():
+            print(f"  {reason}: {N}")
+        clusters_list = df_UCC[df_UCC['UCC_ID'].isin(df_plan['UCC_ID'])]
+    elif new_DB is None:
         # Full list
         clusters_list = df_UCC
     else:
         # Only process 'new_DB' (if given)
-        msk_new_clusters = []
-        for index, cl in df_UCC.iterrows():
-            if new_DB in cl['DB']:
-                msk_new_clusters.append(True)
-            else:
-                msk_new_clusters.append(False)
-        clusters_list = df_UCC[np.array(msk_new_clusters)]
+        clusters_list = df_UCC.iloc[DBs_combine.get_DB_rows(df_UCC, new_DB)]
 
     call_fastMP.run(
         fastMP, G3Q, frames_path, frames_data, df_UCC, df_gcs, UCC_cat,
-        out_path, clusters_list)
+        out_path, clusters_list, N_workers=N_workers, resume=resume)
 
     # This dataframe returns changed by 'call_fastMP', i.e.: it is not in the
     # same state as the version of the dataframe loaded at the top of this
@@ -1,6 +1,8 @@
 
 # import gzip
+from collections import OrderedDict
 import pandas as pd
+import pyarrow.parquet as pq
 import astropy.units as u
 from astropy.coordinates import SkyCoord
 import numpy as np
@@ -19,17 +21,202 @@ Zp_G, sigma_ZG_2 = 25.6873668671, 0.00000759
 Zp_BP, sigma_ZBP_2 = 25.3385422158, 0.000007785
 Zp_RP, sigma_ZRP_2 = 24.7478955012, 0.00001428
 
+# Columns read from the Gaia frames and their new names
+cols_rename = {
+    'source_id': 'Source', 'ra': 'RA_ICRS', 'dec': 'DE_ICRS',
+    'parallax': 'Plx', 'parallax_error': 'e_Plx',
+    'pmra': 'pmRA', 'pmra_error': 'e_pmRA', 'b': 'GLAT',
+    'pmdec': 'pmDE', 'pmdec_error': 'e_pmDE', 'l': 'GLON',
+    'phot_g_mean_flux': 'FG', 'phot_g_mean_flux_error': 'e_FG',
+    'phot_bp_mean_flux': 'FBP', 'phot_bp_mean_flux_error': 'e_FBP',
+    'phot_rp_mean_flux': 'FRP', 'phot_rp_mean_flux_error': 'e_FRP',
+    'radial_velocity': 'RV', 'radial_velocity_error': 'e_RV'}
+
+
+# Columns (original names) stored as float32 when requested. The photometry
+# is converted after obtaining the magnitudes. Coordinates are kept as float64
+cols_float32 = (
+    'parallax', 'parallax_error', 'pmra', 'pmra_error', 'pmdec',
+    'pmdec_error', 'radial_velocity', 'radial_velocity_error')
+
 
 def verbose_p(txt, v, verbose):
     if verbose >= v:
         print(txt)
 
 
+class FramesCache:
+    """
+    LRU cache of decoded Gaia frames, so that the stars shared by
+    neighbouring clusters are read from disk only once. The cache is bounded
+    by the memory used by the stored data
+
+    Parquet frames are read and stored by row groups: only the row groups
+    that can contain stars within the filters of a query are read (as when
+    the filters are pushed down to the parquet reader), and each one is
+    stored unfiltered so that it can be shared by other queries. Other
+    frames are stored whole
+
+    max_mb: memory ceiling (in Mb) for the stored frames
+    """
+
+    def __init__(self, max_mb=2000):
+        self.max_bytes = max_mb * 1024**2
+        self.frames = OrderedDict()
+        self.N_bytes = 0
+        self.hits, self.misses = 0, 0
+        # Row groups statistics of each parquet frame, see 'row_groups'
+        self.stats_rg = {}
+
+    def get(self, file, columns=None, filters=None):
+        """
+        Return the decoded frame, reading it from disk if not cached. The
+        returned dataframe may be shared and must not be modified in place.
+        Stars outside the filters can still be present in the returned frame
+
+        columns: columns to read from the file. Must be the same for all the
+        calls, as the frames are cached by file name (and row group) only
+        filters: pyarrow filters used to select the row groups of parquet
+        frames, see 'query'
+        """
+        if '.parquet' in file and filters is not None:
+            keys = [(file, _) for _ in self.row_groups(file, filters)]
+            if len(keys) == 0:
+                # No stars within the filters
+                return pq.read_schema(file).empty_table().to_pandas()[columns]
+        else:
+            keys = [(file, None)]
+
+        keys_read = [_ for _ in keys if _ not in self.frames]
+        self.hits += len(keys) - len(keys_read)
+        self.misses += len(keys_read)
+        data_read = self.read(file, [rg for _, rg in keys_read], columns)
+
+        parts = []
+        for key in keys:
+            if key in data_read:
+                parts.append(data_read[key])
+            else:
+                self.frames.move_to_end(key)
+                parts.append(self.frames[key][0])
+        # Stored after all the cached parts were retrieved, as storing can
+        # drop them
+        for key, data in data_read.items():
+            self.store(key, data)
+
+        if len(parts) == 1:
+            return parts[0]
+        return pd.concat(parts, ignore_index=True)
+
+    def read(self, file, rgs, columns):
+        """
+        Read a whole frame (rgs=[None]) or a list of row groups of a parquet
+        frame. Returns a dictionary with the data of each (file, rg) key
+        """
+        if len(rgs) == 0:
+            return {}
+        if rgs == [None]:
+            return {(file, None): read_frame(file, columns)}
+
+        # All the row groups are read in a single call
+        pfile = pq.ParquetFile(file)
+        table = pfile.read_row_groups(rgs, columns=columns)
+        data_read, i0 = {}, 0
+        for rg in rgs:
+            N = pfile.metadata.row_group(rg).num_rows
+            data_read[(file, rg)] = table.slice(i0, N).to_pandas()
+            i0 += N
+        return data_read
+
+    def store(self, key, data):
+        """
+        Store a whole frame (key=(file, None)) or a single row group of a
+        parquet frame (key=(file, row group))
+        """
+        N_bytes = int(data.memory_usage(deep=True).sum())
+        # Frames larger than the ceiling are never stored
+        if N_bytes <= self.max_bytes:
+            self.frames[key] = (data, N_bytes)
+            self.N_bytes += N_bytes
+            # Drop the least recently used frames
+            while self.N_bytes > self.max_bytes:
+                _, (_, N_bytes_old) = self.frames.popitem(last=False)
+                self.N_bytes -= N_bytes_old
+
+    def row_groups(self, file, filters):
+        """
+        Indexes of the row groups in the parquet 'file' that can contain
+        stars within the filters, using the min/max statistics stored in
+        the file. Row groups with no statistics are always selected
+        """
+        if file not in self.stats_rg:
+            meta = pq.ParquetFile(file).metadata
+            names = meta.schema.names
+            stats = {}
+            for col in set(_[0] for _ in filters):
+                vmin = np.full(meta.num_row_groups, -np.inf)
+                vmax = np.full(meta.num_row_groups, np.inf)
+                for rg in range(meta.num_row_groups):
+                    st = meta.row_group(rg).column(
+                        names.index(col)).statistics
+                    if st is not None and st.has_min_max:
+                        vmin[rg], vmax[rg] = st.min, st.max
+                stats[col] = (vmin, vmax)
+            self.stats_rg[file] = stats
+
+        stats = self.stats_rg[file]
+        msk = True
+        for col, op, val in filters:
+            vmin, vmax = stats[col]
+            if op == '>=':
+                msk = msk & (vmax >= val)
+            elif op == '>':
+                msk = msk & (vmax > val)
+            elif op == '<=':
+                msk = msk & (vmin <= val)
+            elif op == '<':
+                msk = msk & (vmin < val)
+        return np.flatnonzero(msk).tolist()
+
+    def stats(self):
+        return "Frames cache: {} hits, {} misses, {} parts ({:.0f} Mb)"\
+            .format(self.hits, self.misses, len(self.frames),
+                    self.N_bytes / 1024**2)
+
+
+def frame_part_mb(frames_path, filenames, N_sample=20):
+    """
+    Typical memory (in Mb) used by a single part of a frame stored by
+    'FramesCache', i.e.: the largest row group of a parquet frame (the whole
+    frame if it has a single row group). Estimated as the median over (up
+    to) 'N_sample' frames. Returns None if the frames are not parquet files
+    """
+    files = [_ for _ in filenames if '.parquet' in _]
+    if len(files) == 0:
+        return None
+
+    sizes = []
+    for i in np.linspace(0, len(files) - 1, min(N_sample, len(files))):
+        meta = pq.ParquetFile(frames_path + files[int(i)]).metadata
+        schema = meta.schema.to_arrow_schema()
+        # Bytes per row for the columns read, all of fixed width
+        row_bytes = sum(
+            schema.field(_).type.bit_width // 8 for _ in cols_rename)
+        N_rows = max(
+            meta.row_group(rg).num_rows for rg in range(meta.num_row_groups))
+        sizes.append(N_rows * row_bytes)
+    return np.median(sizes) / 1024**2
+
+
 def run(
-    frames_path, fdata, c_ra, c_dec, box_s_eq, plx_min, max_mag, verbose=0
+    frames_path, fdata, c_ra, c_dec, box_s_eq, plx_min, max_mag, verbose=0,
+    frames_cache=None, float32=False
 ):
     """
     box_s_eq: Size of box to query (in degrees)
+    frames_cache: optional 'FramesCache' shared between calls
+    float32: store the astrometry (except the coordinates) and photometry
+    columns as float32, to reduce the memory used by large frames
     """
     verbose_p("  ({:.3f}, {:.3f}); Box size: {:.2f}, Plx min: {:.2f}".format(
           c_ra, c_dec, box_s_eq, plx_min), 1, verbose)
@@ -52,30 +239,50 @@ def run(
 
         all_frames = query(
             c_ra, c_dec, box_s_eq, frames_path, max_mag, data_in_files,
-            xmin_cl, xmax_cl, ymin_cl, ymax_cl, plx_min, verbose)
+            xmin_cl, xmax_cl, ymin_cl, ymax_cl, plx_min, verbose,
+            frames_cache, float32)
 
         dicts.append(all_frames)
 
     if len(dicts) > 1:
         # Combine
         all_frames = pd.concat([
-            dicts[0], dicts[1]]).drop_duplicates().reset_index(drop=True)
+            pd.DataFrame(dicts[0]), pd.DataFrame(dicts[1])
+        ]).drop_duplicates().reset_index(drop=True)
     else:
         all_frames = dicts[0]
 
-    all_frames = uncertMags(all_frames)
-    all_frames = all_frames.drop(columns=[
-        'FG', 'e_FG', 'FBP', 'e_FBP', 'FRP', 'e_FRP'])
+    # The flux columns are replaced by the magnitudes
+    all_frames = uncertMags(all_frames, float32)
+    # The arrays are not copied into a single block
+    all_frames = pd.DataFrame(all_frames, copy=False)
 
     return all_frames
 
 
+def frames_index(fdata):
+    """
+    Extract the ranges of all the frames as arrays. This is meant to be
+    generated once per run (from the 'frame_ranges' file) and shared by all
+    the processed clusters
+    """
+    return {
+        'filename': np.asarray(fdata['filename']),
+        'ra_min': np.asarray(fdata['ra_min'], dtype=float),
+        'ra_max': np.asarray(fdata['ra_max'], dtype=float),
+        'dec_min': np.asarray(fdata['dec_min'], dtype=float),
+        'dec_max': np.asarray(fdata['dec_max'], dtype=float)}
+
+
 def findFrames(c_ra, c_dec, box_s_eq, fdata, verbose):
     """
+    fdata: frames ranges, either as read from the 'frame_ranges' file or as
+    returned by 'frames_index'
     """
     # These are the points that determine the range of *all* the frames
-    ra_min, ra_max = fdata['ra_min'].values, fdata['ra_max'].values
-    dec_min, dec_max = fdata['dec_min'].values, fdata['dec_max'].values
+    ra_min, ra_max = np.asarray(fdata['ra_min']), np.asarray(fdata['ra_max'])
+    dec_min = np.asarray(fdata['dec_min'])
+    dec_max = np.asarray(fdata['dec_max'])
 
     # frame == 'galactic':
     box_s_eq = np.sqrt(2) * box_s_eq
@@ -88,16 +295,14 @@ def findFrames(c_ra, c_dec, box_s_eq, fdata, verbose):
     xmin_cl, xmax_cl = c_ra - xl, c_ra + xl
     ymin_cl, ymax_cl = c_dec - yl, c_dec + yl
 
-    frame_intersec = np.full(len(fdata), False)
     # Identify which frames contain the cluster region
     l2 = (xmin_cl, ymax_cl)  # Top left
     r2 = (xmax_cl, ymin_cl)  # Bottom right
-    for i, xmin_fr_i in enumerate(ra_min):
-        l1 = (xmin_fr_i, dec_max[i])  # Top left
-        r1 = (ra_max[i], dec_min[i])  # Bottom right
-        frame_intersec[i] = doOverlap(l1, r1, l2, r2)
+    l1 = (ra_min, dec_max)  # Top left of all frames
+    r1 = (ra_max, dec_min)  # Bottom right of all frames
+    frame_intersec = doOverlap(l1, r1, l2, r2)
 
-    data_in_files = list(fdata[frame_intersec]['filename'])
+    data_in_files = np.asarray(fdata['filename'])[frame_intersec].tolist()
     verbose_p(
         f"  Cluster is present in {len(data_in_files)} frames", 1, verbose)
 
@@ -114,6 +319,8 @@ def doOverlap(l1, r1, l2, r2):
     l2: Top Left coordinate of second rectangle.
     r2: Bottom Right coordinate of second rectangle.
 
+    The coordinates can also be arrays, to check many rectangles at once.
+
     Source: https://www.geeksforgeeks.org/find-two-rectangles-overlap/
     """
     min_x1, max_y1 = l1
@@ -121,85 +328,112 @@ def doOverlap(l1, r1, l2, r2):
     min_x2, max_y2 = l2
     max_x2, min_y2 = r2
     # If one rectangle is on left side of other
-    if (min_x1 > max_x2 or min_x2 > max_x1):
-        return False
+    left = (min_x1 > max_x2) | (min_x2 > max_x1)
     # If one rectangle is above other
-    if (min_y1 > max_y2 or min_y2 > max_y1):
-        return False
-    return True
+    above = (min_y1 > max_y2) | (min_y2 > max_y1)
+    return ~(left | above)
 
 
 def query(
     c_ra, c_dec, box_s_eq, frames_path, max_mag, data_in_files, xmin_cl,
-    xmax_cl, ymin_cl, ymax_cl, plx_min, verbose
+    xmax_cl, ymin_cl, ymax_cl, plx_min, verbose, frames_cache=None,
+    float32=False
 ):
     """
+    float32: see 'run'
     """
     # Mag (flux) filter
     min_G_flux = 10**((max_mag - Zp_G) / (-2.5))
 
-    all_frames = []
+    # Only the columns used downstream are read. The filters below are also
+    # used to skip the row groups of parquet frames outside the ranges, by the
+    # parquet reader or by the frames cache
+    columns = list(cols_rename.keys())
+    filters = [
+        ('ra', '>=', xmin_cl), ('ra', '<=', xmax_cl),
+        ('dec', '>=', ymin_cl), ('dec', '<=', ymax_cl),
+        ('parallax', '>', plx_min), ('phot_g_mean_flux', '>', min_G_flux)]
+
+    # The selected stars are stored as one array per column, so that the
+    # columns can be joined, filtered, and freed one at a time
+    frames = []
     for i, file in enumerate(data_in_files):
-        if '.csv' in file:
-            data = pd.read_csv(frames_path + file)
-        elif '.parquet' in file:
-            data = pd.read_parquet(frames_path + file)
+        if frames_cache is None:
+            data = read_frame(frames_path + file, columns, filters)
+        else:
+            data = frames_cache.get(frames_path + file, columns, filters)
 
         mx = (data['ra'] >= xmin_cl) & (data['ra'] <= xmax_cl)
         my = (data['dec'] >= ymin_cl) & (data['dec'] <= ymax_cl)
         m_plx = data['parallax'] > plx_min
         m_gmag = data['phot_g_mean_flux'] > min_G_flux
-        msk = (mx & my & m_plx & m_gmag)
+        msk = (mx & my & m_plx & m_gmag).values
 
         verbose_p(
             f"{i+1}, {file} contains {msk.sum()} cluster stars", 2, verbose)
         if msk.sum() == 0:
             continue
 
-        all_frames.append(data[msk])
-    all_frames = pd.concat(all_frames)
+        frame = {}
+        for col in columns:
+            frame[col] = data[col].values[msk]
+            if float32 and col in cols_float32:
+                frame[col] = frame[col].astype(np.float32)
+        frames.append(frame)
+        del data
+
+    all_frames = {}
+    for col in columns:
+        all_frames[col] = np.concatenate([_.pop(col) for _ in frames])
 
-    verbose_p(f"  {len(all_frames)} stars retrieved", 2, verbose)
+    verbose_p(f"  {len(all_frames['l'])} stars retrieved", 2, verbose)
 
     c_ra, c_dec = c_ra, c_dec
     box_s_h = box_s_eq * .5
     gal_cent = radec2lonlat(c_ra, c_dec)
 
-    if all_frames['l'].max() - all_frames['l'].min() > 180:
+    lon = all_frames['l']
+    if lon.max() - lon.min() > 180:
         verbose_p("Frame wraps around 360 in longitude. Fixing..", 1, verbose)
 
-        lon = all_frames['l'].values
         if gal_cent[0] > 180:
             msk = lon < 180
             lon[msk] += 360
         else:
             msk = lon > 180
             lon[msk] -= 360
-        all_frames['l'] = lon
 
     xmin_cl, xmax_cl = gal_cent[0] - box_s_h, gal_cent[0] + box_s_h
     ymin_cl, ymax_cl = gal_cent[1] - box_s_h, gal_cent[1] + box_s_h
-    mx = (all_frames['l'] >= xmin_cl) & (all_frames['l'] <= xmax_cl)
+    mx = (lon >= xmin_cl) & (lon <= xmax_cl)
     my = (all_frames['b'] >= ymin_cl) & (all_frames['b'] <= ymax_cl)
     msk = (mx & my)
-    all_frames = all_frames[msk]
-
-    all_frames = all_frames.rename(columns={
-        'source_id': 'Source', 'ra': 'RA_ICRS', 'dec': 'DE_ICRS',
-        'parallax': 'Plx', 'parallax_error': 'e_Plx',
-        'pmra': 'pmRA', 'pmra_error': 'e_pmRA', 'b': 'GLAT',
-        'pmdec': 'pmDE', 'pmdec_error': 'e_pmDE', 'l': 'GLON',
-        'phot_g_mean_flux': 'FG', 'phot_g_mean_flux_error': 'e_FG',
-        'phot_bp_mean_flux': 'FBP', 'phot_bp_mean_flux_error': 'e_FBP',
-        'phot_rp_mean_flux': 'FRP', 'phot_rp_mean_flux_error': 'e_FRP',
-        'radial_velocity': 'RV', 'radial_velocity_error': 'e_RV'}
-    )
-
-    verbose_p(f"  {len(all_frames)} stars final", 1, verbose)
+    if not msk.all():
+        for col in columns:
+            all_frames[col] = all_frames[col][msk]
+
+    all_frames = {cols_rename[k]: v for k, v in all_frames.items()}
+
+    verbose_p(f"  {len(all_frames['GLON'])} stars final", 1, verbose)
     return all_frames
 
 
-def uncertMags(data):
+def read_frame(file, columns=None, filters=None):
+    """
+    Read a Gaia frame file
+
+    columns: columns to read (all if None)
+    filters: pyarrow filters applied when reading parquet files, ignored for
+    csv files
+    """
+    if '.csv' in file:
+        data = pd.read_csv(file, usecols=columns)
+    elif '.parquet' in file:
+        data = pd.read_parquet(file, columns=columns, filters=filters)
+    return data
+
+
+def uncertMags(data, float32=False):
     """
     # Gaia DR3 zero points:
     https://www.cosmos.esa.int/web/gaia/dr3-passbands
@@ -207,26 +441,53 @@ def uncertMags(data):
     "The GBP (blue curve), G (green curve) and GRP (red curve) passbands are
     applicable to both Gaia Early Data Release 3 as well as to the full Gaia
     Data Release 3"
-    """
-    I_G, e_IG = data['FG'].values, data['e_FG'].values
-    I_BP, e_IBP = data['FBP'].values, data['e_FBP'].values
-    I_RP, e_IRP = data['FRP'].values, data['e_FRP'].values
 
-    data['Gmag'] = Zp_G + -2.5 * np.log10(I_G)
-    BPmag = Zp_BP + -2.5 * np.log10(I_BP)
-    RPmag = Zp_RP + -2.5 * np.log10(I_RP)
-    data['BP-RP'] = BPmag - RPmag
+    The magnitudes and their uncertainties are computed in place on as few
+    arrays as possible, and the flux columns are removed from 'data' (a
+    dataframe or a dictionary of arrays, which is modified)
 
-    e_G = np.sqrt(sigma_ZG_2 + 1.179 * (e_IG / I_G)**2)
-    data['e_Gmag'] = e_G
-    e_BP = np.sqrt(sigma_ZBP_2 + 1.179 * (e_IBP / I_BP)**2)
-    e_RP = np.sqrt(sigma_ZRP_2 + 1.179 * (e_IRP / I_RP)**2)
-    data['e_BP-RP'] = np.sqrt(e_BP**2 + e_RP**2)
+    float32: store the new columns as float32
+    """
+    dtype = np.float32 if float32 else np.float64
+
+    def mag_e2(flux, e_flux, Zp, sigma_Z_2):
+        """Magnitude and squared uncertainty for a single band"""
+        I_f = np.asarray(data.pop(flux))
+        e_I_f = np.asarray(data.pop(e_flux))
+        e2 = np.divide(e_I_f, I_f, dtype=dtype)
+        e2 *= e2
+        e2 *= 1.179
+        e2 += sigma_Z_2
+        mag = np.log10(I_f, dtype=dtype)
+        mag *= -2.5
+        mag += Zp
+        return mag, e2
+
+    Gmag, e_G = mag_e2('FG', 'e_FG', Zp_G, sigma_ZG_2)
+    data['Gmag'] = Gmag
+    BPmag, e_BP = mag_e2('FBP', 'e_FBP', Zp_BP, sigma_ZBP_2)
+    RPmag, e_RP = mag_e2('FRP', 'e_FRP', Zp_RP, sigma_ZRP_2)
+    BPmag -= RPmag
+    data['BP-RP'] = BPmag
+    del RPmag
+
+    data['e_Gmag'] = np.sqrt(e_G, out=e_G)
+    # e_BP**2 + e_RP**2, with the square roots taken first (as in the
+    # original computation) so that the values are the same
+    for e2 in (e_BP, e_RP):
+        np.square(np.sqrt(e2, out=e2), out=e2)
+    e_BP += e_RP
+    data['e_BP-RP'] = np.sqrt(e_BP, out=e_BP)
 
     return data
 
 
 def radec2lonlat(ra, dec):
+    """
+    Transform equatorial coordinates to galactic. Accepts single values or
+    arrays, which are transformed in a single call
+    """
+    ra, dec = np.asarray(ra, dtype=float), np.asarray(dec, dtype=float)
     gc = SkyCoord(ra=ra * u.degree, dec=dec * u.degree)
     lb = gc.transform_to('galactic')
     lon, lat = lb.l.value, lb.b.value
@@ -0,0 +1,153 @@
+
+import numpy as np
+import pandas as pd
+from . import call_fastMP
+from .DBs_combine import dups_identify
+from .duplicates_id import coords_tree
+
+
+# Parameters that define the center of a cluster used by fastMP
+cent_cols = ('GLON', 'GLAT', 'pmRA', 'pmDE', 'plx')
+
+
+def run(df_old, df_new, df_gcs, tol=1e-6):
+    """
+    Find the clusters in the new version of the UCC ('df_new', as generated
+    by 'add_new_DB') that need to be re-processed with fastMP, compared to the
+    old version ('df_old'). Clusters are matched through their UCC_ID.
+
+    The reasons to re-process a cluster are:
+
+    - new: cluster not present in the old version
+    - unprocessed: cluster with no fastMP results in the old version
+    - center: any of its center values (GLON, GLAT, pmRA, pmDE, plx) changed
+    - duplicates: its set of probable duplicates changed
+    - neighbours: the set of close clusters removed from its frame (see
+      'call_fastMP.get_close_cls') changed
+
+    tol: maximum difference allowed for two center values to be equal
+
+    Returns a dataframe with the columns 'UCC_ID', 'fname', 'reasons' (';'
+    separated) for the clusters that need re-processing
+    """
+    df_old = df_old.reset_index(drop=True)
+    df_new = df_new.reset_index(drop=True)
+
+    # Row in the old version for each cluster in the new one (-1 if new). If
+    # a UCC_ID is repeated in the old version, its first row is used
+    rows_old = pd.Series(np.arange(len(df_old)), index=df_old['UCC_ID'])
+    rows_old = rows_old[~rows_old.index.duplicated()]
+    idx_old = rows_old.reindex(df_new['UCC_ID']).fillna(-1).values
+    idx_old = idx_old.astype(int)
+    msk_in = idx_old >= 0
+
+    msk_new = ~msk_in
+    msk_unproc = np.zeros(len(df_new), dtype=bool)
+    msk_unproc[msk_in] = df_old['N_ex_cls'].isna().values[idx_old[msk_in]]
+    msk_cent = center_changed(df_old, df_new, idx_old, tol)
+
+    # Duplicates as used by fastMP for the old version, i.e.: not the final
+    # duplicates stored in the catalogue
+    dups_old = np.array(dups_identify(df_old)[0], dtype=object)
+    dups_new = df_new['dups_fnames'].astype(str).values
+    msk_dups = np.zeros(len(df_new), dtype=bool)
+    msk_dups[msk_in] = [
+        fnames_set(a) != fnames_set(b)
+        for a, b in zip(dups_old[idx_old[msk_in]], dups_new[msk_in])]
+
+    # Clusters added, removed, moved, or renamed are the ones that can change
+    # the neighbours of other clusters
+    fnames_old = df_old['fnames'].values
+    msk_chg_new = msk_new | msk_cent
+    msk_chg_new[msk_in] |= fnames_old[idx_old[msk_in]] != \
+        df_new['fnames'].values[msk_in]
+    msk_chg_old = np.ones(len(df_old), dtype=bool)
+    msk_chg_old[idx_old[msk_in]] = msk_chg_new[msk_in]
+    xy_chg = np.concatenate([
+        df_old[['GLON', 'GLAT']].values[msk_chg_old],
+        df_new[['GLON', 'GLAT']].values[msk_chg_new]])
+
+    # Only the clusters with one of these within their frame's radius can
+    # have their neighbours changed
+    msk_neigh = np.zeros(len(df_new), dtype=bool)
+    if len(xy_chg) > 0:
+        box_s_old, box_s_new = frame_sizes(df_old), frame_sizes(df_new)
+        # Radius that contains the entire frame
+        rads = np.sqrt(2) * box_s_new / 2
+        tree_chg = coords_tree(xy_chg[:, 0], xy_chg[:, 1])
+        N_close = tree_chg.query_ball_point(
+            np.array([df_new['GLON'].values % 360, df_new['GLAT'].values]).T,
+            rads, return_length=True)
+        # Those already marked for re-processing are not checked
+        idx_check = np.where(
+            (N_close > 0) & msk_in & ~msk_unproc & ~msk_cent
+            & ~msk_dups)[0]
+        cls_old = call_fastMP.close_cls_data(df_old, df_gcs)
+        cls_new = call_fastMP.close_cls_data(df_new, df_gcs)
+        for i in idx_check:
+            j = idx_old[i]
+            msk_neigh[i] = close_cls_key(
+                df_old, j, box_s_old[j], dups_old[j], cls_old) != \
+                close_cls_key(df_new, i, box_s_new[i], dups_new[i], cls_new)
+
+    reasons = []
+    for msk, reason in (
+        (msk_new, 'new'), (msk_unproc, 'unprocessed'), (msk_cent, 'center'),
+            (msk_dups, 'duplicates'), (msk_neigh, 'neighbours')):
+        reasons.append(np.where(msk, reason, ''))
+    reasons = [';'.join(_ for _ in r if _) for r in zip(*reasons)]
+
+    df_plan = pd.DataFrame({
+        'UCC_ID': df_new['UCC_ID'].values,
+        'fname': [_.split(';')[0] for _ in df_new['fnames']],
+        'reasons': reasons})
+    return df_plan[df_plan['reasons'] != ''].reset_index(drop=True)
+
+
+def center_changed(df_old, df_new, idx_old, tol):
+    """
+    Mask of the clusters in 'df_new' with a center that differs from the one
+    in 'df_old'. Clusters not present in 'df_old' are not marked
+    """
+    msk_in = idx_old >= 0
+    msk = np.zeros(len(df_new), dtype=bool)
+    for col in cent_cols:
+        v_old = df_old[col].values[idx_old[msk_in]]
+        v_new = df_new[col].values[msk_in]
+        msk[msk_in] |= ~np.isclose(
+            v_old, v_new, rtol=0, atol=tol, equal_nan=True)
+    return msk
+
+
+def fnames_set(fnames):
+    """
+    Set of fnames in a ';' separated string ('nan' is the empty set)
+    """
+    if fnames == 'nan':
+        return set()
+    return set(fnames.split(';'))
+
+
+def frame_sizes(df_UCC):
+    """
+    Size of the frame processed by fastMP for each cluster, see
+    'call_fastMP.get_frame' and 'call_fastMP.process_cluster'
+    """
+    box_s = call_fastMP.box_size(df_UCC['plx'].values)
+    box_s[df_UCC['ID'].str.contains('Ryu').values] = 10 / 60
+    fnames0 = df_UCC['fnames'].str.split(';').str[0]
+    box_s[fnames0.str.startswith('ubc').values] *= 3
+    return box_s
+
+
+def close_cls_key(df_UCC, idx, box_s, dups_fnames, cls_data):
+    """
+    Hashable version of the close clusters passed to fastMP for the cluster
+    in row 'idx'
+    """
+    cl = df_UCC.iloc[idx]
+    centers_ex = call_fastMP.get_close_cls(
+        cl['GLON'], cl['GLAT'], box_s, idx, dups_fnames, cls_data)
+    return sorted(
+        tuple((k, tuple(v)) for k, v in sorted(_.items()))
+        for _ in centers_ex)
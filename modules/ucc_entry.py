@@ -61,7 +61,7 @@ data_table2 = """         </td>
          <th>pmRA</th>
          <th>pmDE</th>
          <th>Rv</th>
-         <th>N_20</th>
+         <th>N_50</th>
       </tr>
       <!-- Row 4 -->
       <tr>
@@ -133,7 +133,7 @@ data_foot = """\n
 
 
 def make_entry(
-    entries_path, cl_names, Qfold, fname, ucc_id, C1, C2, abcd_c, Nmemb,
+    entries_path, cl_names, Qfold, fname, ucc_id, C1, C2, C3, abcd_c, Nmemb,
     lon, lat, ra, dec, plx, pmra, pmde, rv, fpars_table, posit_table,
     close_table
 ):
@@ -144,7 +144,7 @@ def make_entry(
     txt += aladin_header
     txt += aladin_table1[:-1] + "{}".format(ra) + " " + "{}".format(dec)
     txt += aladin_table2
-    txt += data_table1.format(ucc_id, abcd_v, ra, dec, lon, lat, )
+    txt += data_table1.format(ucc_id, C3, ra, dec, lon, lat, )
     txt += abcd_c
     txt += data_table2.format(plx, pmra, pmde, rv, Nmemb)
     if len(cl_names) > 1:
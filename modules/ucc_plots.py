@@ -13,20 +13,11 @@ plt.style.use('science')
 # matplotlib.rcParams.update({'font.size': 22})
 
 
-def make_plot(out_path, fname0, df, N_membs_min, cmap='viridis', dpi=200):
+def make_plot(out_path, fname0, df_membs, df_field, cmap='viridis', dpi=200):
     """
+    df_membs, df_field: members and field stars, see
+    'make_entries.split_membs_field'
     """
-    # Select members and field stars
-    msk_membs = df['probs'] > 0.5
-    if msk_membs.sum() < N_membs_min:
-        # Select the first '' stars assuming that the data is order by
-        # probabilities
-        idx = np.arange(N_membs_min)
-        msk_membs = np.full(len(df), False)
-        msk_membs[idx] = True
-    df_membs = df[msk_membs]
-    df_field = df[~msk_membs]
-
     pr = df_membs['probs']
     vmin = min(pr)
 
@@ -94,6 +85,8 @@ def make_plot(out_path, fname0, df, N_membs_min, cmap='viridis', dpi=200):
 
     fig.tight_layout()
     plt.savefig(out_path + fname0 + ".png", dpi=dpi)
+    # Release the figure, many plots are generated by the same process
+    plt.close(fig)
 
 
 def colorbar(mappable):
@@ -0,0 +1,66 @@
+
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from modules import main_process_GDR3_query as G3Q
+
+"""
+One-time tool to repack the Gaia frames used by the fastMP call. Each frame is
+re-written as a parquet file sorted by Dec zones and then by RA, using small
+row groups. The min/max statistics stored for each row group allow the
+parquet reader in 'main_process_GDR3_query' to skip most of the rows of a
+frame that fall outside the queried box.
+"""
+
+#
+# Paths to the original frames and ranges file
+GAIADR3_path = '/media/gabriel/backup/gabriel/GaiaDR3/'
+frames_path = GAIADR3_path + 'datafiles_G20/'
+frames_ranges = GAIADR3_path + 'files_G20/frame_ranges.txt'
+# Paths to the repacked frames and their ranges file
+frames_path_out = GAIADR3_path + 'datafiles_G20_sorted/'
+frames_ranges_out = GAIADR3_path + 'files_G20/frame_ranges_sorted.txt'
+
+
+def main(dec_zone=0.25, row_group_size=10000):
+    """
+    dec_zone: height (in degrees) of the Dec zones used to sort the stars
+    row_group_size: number of stars per row group in the repacked frames
+    """
+    Path(frames_path_out).mkdir(parents=True, exist_ok=True)
+
+    fdata = pd.read_csv(frames_ranges)
+
+    fnames_out = []
+    for i, file in enumerate(fdata['filename']):
+        data = G3Q.read_frame(frames_path + file)
+        data = sort_frame(data, dec_zone)
+
+        file_out = file.split('.csv')[0].split('.parquet')[0] + '.parquet'
+        data.to_parquet(
+            frames_path_out + file_out, index=False,
+            row_group_size=row_group_size)
+        fnames_out.append(file_out)
+
+        N_groups = int(np.ceil(len(data) / row_group_size))
+        print(f"{i+1}/{len(fdata)} {file_out}: {len(data)} stars, "
+              + f"{N_groups} row groups")
+
+    # Frames ranges are not changed, only the file names
+    fdata['filename'] = fnames_out
+    fdata.to_csv(frames_ranges_out, index=False)
+    print(f"File {frames_ranges_out} generated")
+
+
+def sort_frame(data, dec_zone):
+    """
+    Sort the stars in Dec zones of 'dec_zone' degrees, and by RA inside each
+    zone, so that each row group covers a small (RA, Dec) region
+    """
+    zone = np.floor(data['dec'].values / dec_zone)
+    idx = np.lexsort((data['ra'].values, zone))
+    return data.iloc[idx].reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+import numpy as np
+from modules import DBs_combine
+
+
+def test_format_UCC_ids():
+    ucc_ids = DBs_combine.format_UCC_ids(
+        np.array([5.12, 123.45, 300.]), np.array([-3.21, 12.34, 0.]))
+    assert ucc_ids == ['UCC G005.1-03.2', 'UCC G123.4+12.3', 'UCC G300.0+00.0']
+
+
+def test_assign_no_new_clusters():
+    # All the clusters in the new DB are already in the catalogue
+    ucc_ids = DBs_combine.UCCIDAllocator(['UCC G005.1-03.2'])
+    assert ucc_ids.assign(np.array([]), np.array([])) == []
+
+
+def test_assign_collisions():
+    ucc_ids = DBs_combine.UCCIDAllocator(['UCC G005.1-03.2'])
+    assert ucc_ids.assign(np.array([5.12, 5.13]), np.array([-3.21, -3.22])) \
+        == ['UCC G005.1-03.2a', 'UCC G005.1-03.2b']